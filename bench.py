@@ -0,0 +1,354 @@
+#!/usr/bin/env python3.7
+'''Micro-benchmarks for the hot paths of the bot.
+
+Usage: ./bench.py [benchmark ...]   (runs all of them by default)
+
+The e2e benchmark runs the whole bot against simulated phones (see
+fakeadb.py), so it needs no hardware either.
+'''
+import asyncio
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import numpy as np
+from PIL import Image
+
+import fakeadb
+import questr
+from cooldown import calculate, calculateArray, calculateCD, calculateCDArray, haversine, splitCoords
+from journal import Journal
+from ocr import OcrPool
+from pokemonlib import PokemonGo
+from recorder import FlightRecorder
+from scheduler import SimulatedClock
+from stops import load_stops
+from tracing import Tracer
+from vision import classify_hues
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def report(name, seconds, number):
+    print('{:<46} {:>10.3f} ms/call'.format(name, seconds / number * 1000))
+
+
+def old_hue(im):
+    '''What Main.hue_affinity used to do before vision.classify_hues.'''
+    im = im.quantize()
+    im = im.resize((1, 1))
+    im = im.convert('HSV')
+    return im.getpixel((0, 0))[0]
+
+
+def bench_hue():
+    rng = np.random.RandomState(0)
+    crops = []
+    for _ in range(32):
+        color = np.array([90, 110, 230]) + rng.randint(-20, 20, size=(27, 60, 3))
+        crops.append(Image.fromarray(np.clip(color, 0, 255).astype(np.uint8), 'RGB'))
+
+    number = 20
+    report('hue: quantize/resize, one crop', timeit.timeit(lambda: old_hue(crops[0]), number=number), number)
+    report('hue: numpy, one crop', timeit.timeit(lambda: classify_hues(crops[:1], 130, 200), number=number), number)
+    report('hue: quantize/resize, 32 crops', timeit.timeit(lambda: [old_hue(c) for c in crops], number=number), number)
+    report('hue: numpy, 32 crops batched', timeit.timeit(lambda: classify_hues(crops, 130, 200), number=number), number)
+
+
+def bench_cooldown():
+    rng = np.random.RandomState(0)
+    stops = np.column_stack([rng.uniform(-60, 60, 10000), rng.uniform(-180, 180, 10000)])
+    legs = list(zip(stops[:-1, 0], stops[:-1, 1], stops[1:, 0], stops[1:, 1]))
+
+    def scalar():
+        # One pair at a time, with the plain math haversine gpxpy used.
+        return [calculateCD(round(haversine(*leg) / 1000, 2)) for leg in legs]
+
+    def vectorized():
+        return calculateCDArray(calculateArray(stops[:-1, 0], stops[:-1, 1], stops[1:, 0], stops[1:, 1]))
+
+    def matrix_rows():
+        # 100 rows of the 10k x 10k matrix, which doesn't fit in memory at once.
+        return calculateCDArray(calculateArray(stops[:100, None, 0], stops[:100, None, 1], stops[None, :, 0], stops[None, :, 1]))
+
+    number = 5
+    report('cooldown: 10k legs, scalar loop', timeit.timeit(scalar, number=number), number)
+    report('cooldown: 10k legs, calculate() wrapper', timeit.timeit(lambda: [calculateCD(calculate(*leg)) for leg in legs], number=1), 1)
+    report('cooldown: 10k legs, vectorized', timeit.timeit(vectorized, number=number), number)
+    report('cooldown: 100 x 10k matrix rows, vectorized', timeit.timeit(matrix_rows, number=number), number)
+
+
+def bench_tracing():
+    def bare():
+        pass
+
+    def traced(tracer):
+        with tracer.span('adb shell input', 'fake0', args='input tap 540 1250'):
+            pass
+
+    off, on, events = Tracer(), Tracer(), Tracer()
+    on.enable()
+    events.enable(events=True)
+    # Per 1000 spans, since a single one is way below a millisecond.
+    number = 100
+    report('tracing: 1000 empty blocks', timeit.timeit(bare, number=number * 1000), number)
+    report('tracing: 1000 spans, disabled', timeit.timeit(lambda: traced(off), number=number * 1000), number)
+    report('tracing: 1000 spans, histograms only', timeit.timeit(lambda: traced(on), number=number * 1000), number)
+    report('tracing: 1000 spans, histograms and events', timeit.timeit(lambda: traced(events), number=number * 1000), number)
+
+
+def bench_journal():
+    state = dict(quest_list='37e41836b7f08571', stop=1234, done=True, actions_so_far=2,
+                 last_spin=[-23.550520, -46.633308, 1554139200.0])
+    with tempfile.TemporaryDirectory() as directory:
+        journal = Journal(os.path.join(directory, 'journal'), compact_bytes=1 << 30)
+        number = 10000
+        report('journal: append, fsync every 16', timeit.timeit(lambda: journal.append('spin', **state), number=number), number)
+        journal.sync_every = 1
+        report('journal: append, fsync every one', timeit.timeit(lambda: journal.append('spin', **state), number=1000), 1000)
+        journal.sync_every = 16
+        for _ in range(90000):
+            journal.append('spin', **state)
+        journal.close()
+        report('journal: resume from 100k records', timeit.timeit(lambda: Journal(journal.filename).load(), number=100), 100)
+        report('journal: compact 100k records', timeit.timeit(journal.compact, number=1), 1)
+
+
+def bench_stops():
+    rng = np.random.RandomState(0)
+    coords = np.column_stack([rng.uniform(40, 41, 50000), rng.uniform(-75, -74, 50000)])
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'quest_list.txt')
+        with open(filename, 'w') as f:
+            f.write(''.join('{:.6f},{:.6f}\n'.format(*coord) for coord in coords))
+
+        def lines():
+            # What Main.start used to do before stops.py.
+            with open(filename, 'r') as file:
+                return [splitCoords(line) for line in file.read().splitlines()]
+
+        report('stops: 50k lines, splitlines + splitCoords', timeit.timeit(lines, number=1), 1)
+        report('stops: 50k lines, parse + dedupe', timeit.timeit(lambda: load_stops(filename, cache=False), number=1), 1)
+        stops = load_stops(filename)
+        report('stops: 50k lines, cached', timeit.timeit(lambda: load_stops(filename), number=20), 20)
+        stops.visited[rng.rand(len(stops)) < 0.5] = True
+        report('stops: grid index build', timeit.timeit(lambda: stops.__class__(stops.coords).index, number=5), 5)
+        report('stops: nearest unvisited within 2km', timeit.timeit(lambda: stops.nearest_unvisited(coords[0], 2), number=1000), 1000)
+
+
+def bench_recorder(number=200):
+    '''Cost of recording on the hot path, and what the worker makes of
+    a stream of full size raw frames.
+    '''
+    frames = []
+    for i in range(8):
+        im = fakeadb.render(fakeadb.SCREENS[i], questr.yaml.safe_load(open(os.path.join(HERE, 'config.yaml'))))
+        frames.append((im.size[0], im.size[1], 'RGBA', im.convert('RGBA').tobytes()))
+
+    recorder = FlightRecorder(max_bytes=256 << 10)
+    report('recorder: event', timeit.timeit(lambda: recorder.event('tap', location='pokestop'), number=100000), 100000)
+    spent = 0
+    for i in range(number):
+        started = time.perf_counter()
+        recorder.frame(frames[i % len(frames)], i)
+        spent += time.perf_counter() - started
+        time.sleep(0.01)
+    report('recorder: frame, every 10ms', spent, number)
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.time()
+        recorder.dump(directory, 'bench', 'benchmark')
+        report('recorder: dump', time.time() - started, 1)
+    recorder.close()
+    print('{:<46} {:>10} frames  ({:.0f} KB each, {} dropped, {:.0f} of {:.0f} KB cap)'.format(
+        'recorder: kept', len(recorder.frames), recorder.frame_bytes / max(1, len(recorder.frames)) / 1024,
+        recorder.dropped, recorder.frame_bytes / 1024, recorder.max_bytes / 1024))
+
+
+IMPORT_PROBE = '''
+import sys, time
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start, 'gi' in sys.modules)
+'''
+
+
+def time_import(statement, number=5):
+    '''Best of number fresh interpreters, so nothing is cached in sys.modules.
+
+    Returns:
+        {(float, bool)} -- Seconds the import took and whether it pulled in gi,
+                           or None if it fails here.
+    '''
+    best = None
+    for _ in range(number):
+        result = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(statement)], cwd=HERE,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        if result.returncode != 0:
+            return None
+        seconds, gi = result.stdout.split()
+        if best is None or float(seconds) < best[0]:
+            best = (float(seconds), gi == 'True')
+    return best
+
+
+def bench_imports():
+    '''What the bot pays at startup, next to the GTK stack it no longer loads.'''
+    statements = [
+        ('cooldown', 'import cooldown'),
+        ('scheduler', 'import scheduler'),
+        ('questr', 'import questr'),
+        ('COOLmeDOWN (watcher, not launched)', 'import COOLmeDOWN'),
+        ('GTK + libnotify', "import gi; gi.require_version('Gtk', '3.0'); gi.require_version('Notify', '0.7'); "
+                            "from gi.repository import Gtk, Gdk, Notify"),
+    ]
+    for name, statement in statements:
+        result = time_import(statement)
+        if result is None:
+            print('{:<46} {:>10}'.format('import: ' + name, 'unavailable'))
+        else:
+            print('{:<46} {:>10.3f} ms      gi loaded: {}'.format('import: ' + name, result[0] * 1000, result[1]))
+
+
+def fake_phones(directory, devices, config):
+    '''Puts a fake adb first on PATH, simulating the given devices.'''
+    os.makedirs(os.path.join(directory, 'bin'))
+    adb = os.path.join(directory, 'bin', 'adb')
+    with open(adb, 'w') as f:
+        f.write('#!/bin/sh\nexec {} {} "$@"\n'.format(sys.executable, os.path.join(HERE, 'fakeadb.py')))
+    os.chmod(adb, 0o755)
+    os.environ['PATH'] = os.path.dirname(adb) + os.pathsep + os.environ['PATH']
+    os.environ['FAKEADB_DIR'] = os.path.join(directory, 'devices')
+    os.environ['FAKEADB_DEVICES'] = ','.join(devices)
+    os.environ['FAKEADB_CONFIG'] = config
+
+
+def fake_templates(directory, config):
+    '''Records templates off the simulated screens, like ./states.py would.'''
+    for screen, (location, text) in fakeadb.TEXTS.items():
+        im = fakeadb.render(screen, config)
+        path = os.path.join(directory, '{}x{}'.format(*im.size), location)
+        os.makedirs(path, exist_ok=True)
+        im.crop(config['locations'][location]).save(os.path.join(path, 'fake.png'))
+
+
+def run_e2e(devices=2, stops=4, options=(), label='e2e', details=True):
+    '''Drives questr.Rack through a short route on simulated phones.
+
+    Cooldowns run on a simulated clock, so stops/h is how fast the bot
+    itself goes: capture, analysis, input and waiting for the screen.
+
+    Keyword Arguments:
+        options {list} -- Extra questr.py command line arguments.
+        details {bool} -- Also report latencies and CPU, not just stops/h.
+    '''
+    config_file = os.path.join(HERE, 'config.yaml')
+    config = questr.yaml.safe_load(open(config_file))
+    devices = ['fake{}'.format(i) for i in range(devices)]
+    logging.getLogger('ivcheck').setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as directory:
+        fake_phones(directory, devices, config_file)
+        fake_templates(os.path.join(directory, 'templates'), config)
+        quest_list = os.path.join(directory, 'quest_list.txt')
+        with open(quest_list, 'w') as f:
+            f.write(''.join('{:.6f},{:.6f}\n'.format(-23.55 + i * 0.001, -46.63) for i in range(stops * len(devices))))
+
+        args = questr.parse_args(['--all-devices', '--config', config_file, '--quest-list', quest_list,
+                                  '--templates', os.path.join(directory, 'templates'), '--report-every', '3600',
+                                  '--journal', os.path.join(directory, 'journal')] + [str(option) for option in options])
+        ocr = OcrPool(args.ocr_workers) if shutil.which('tesseract') else fakeadb.FakeOcr(config)
+        rack = questr.Rack(args, ocr, SimulatedClock(time.time()))
+
+        before_self, before_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        started = time.time()
+        try:
+            asyncio.run(rack.start())
+        finally:
+            ocr.close()
+        elapsed = time.time() - started
+        after_self, after_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        cpu_bot = after_self.ru_utime + after_self.ru_stime - before_self.ru_utime - before_self.ru_stime
+        cpu_adb = after_children.ru_utime + after_children.ru_stime - before_children.ru_utime - before_children.ru_stime
+        for device, main in rack.mains.items():
+            with open(os.path.join(directory, 'devices', device, 'state.json')) as f:
+                phone = json.load(f)
+            print('{:<46} {:>10.1f} stops/h  ({} spins, {} screenshots, {} inputs)'.format(
+                '{}: {}'.format(label, device), main.spins / elapsed * 3600, phone['spins'], phone['screencaps'], phone['inputs']))
+            if not details:
+                continue
+            for transition, samples in sorted(main.latencies.items()):
+                report('{}: {} {} (p50)'.format(label, device, transition), float(np.median([s[0] for s in samples])), 1)
+        if details:
+            print('{:<46} {:>10.3f} s/device  (bot {:.1f}s, fake adb {:.1f}s, wall {:.1f}s)'.format(
+                label + ': CPU', (cpu_bot + cpu_adb) / len(devices), cpu_bot, cpu_adb, elapsed))
+
+
+def bench_e2e():
+    run_e2e()
+
+
+def bench_pipeline():
+    '''Stops/h of one phone capturing one screenshot at a time, and
+    capturing ahead in the background.
+    '''
+    for depth in (0, 1, 2):
+        run_e2e(1, 6, ['--pipeline-depth', depth], 'pipeline: depth {}'.format(depth), details=False)
+
+
+def bench_touch(number=10):
+    '''Taps and swipes on a simulated phone, whose `input` takes 300ms
+    to start like on a real one, through each touch path.
+    '''
+    config_file = os.path.join(HERE, 'config.yaml')
+    os.environ['FAKEADB_INPUT_LATENCY'] = '0.3'
+    gesture = [('tap', 540, 1250), ('wait', 100), ('swipe', 150, 1040, 540, 1040, 300), ('wait', 100), ('tap', 540, 2020)]
+
+    async def measure(name, p):
+        await p.set_device('fake0')
+        await p.tap(540, 2020)  # warm up: connect, start daemons
+        started = time.time()
+        for _ in range(number):
+            await p.tap(540, 2020)
+        report('touch: tap, ' + name, time.time() - started, number)
+        started = time.time()
+        for _ in range(number):
+            await p.swipe(150, 1040, 540, 1040, 300)
+        report('touch: 300ms swipe, ' + name, time.time() - started, number)
+        started = time.time()
+        for _ in range(number):
+            await p.gesture(gesture)
+        report('touch: 5 step gesture (500ms), ' + name, time.time() - started, number)
+        await p.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        fake_phones(directory, ['fake0'], config_file)
+        asyncio.run(measure('input', PokemonGo()))
+        asyncio.run(measure('persistent input', PokemonGo(use_persistent_shell=True)))
+        asyncio.run(measure('minitouch', PokemonGo(touch='minitouch')))
+    del os.environ['FAKEADB_INPUT_LATENCY']
+
+
+BENCHMARKS = {
+    'hue': bench_hue,
+    'cooldown': bench_cooldown,
+    'tracing': bench_tracing,
+    'journal': bench_journal,
+    'stops': bench_stops,
+    'imports': bench_imports,
+    'recorder': bench_recorder,
+    'touch': bench_touch,
+    'e2e': bench_e2e,
+    'pipeline': bench_pipeline,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
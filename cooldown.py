@@ -0,0 +1,238 @@
+'''Pokestop cooldowns: how long to wait between spins depending on
+how far apart they are, and the coordinate parsing and distance math
+behind them. Plain python and numpy, no GUI involved.
+'''
+import math
+import re
+import time
+from bisect import bisect_right
+
+import numpy as np
+
+
+def prettifyCoord(coord, n=6):
+    '''Prettifies a coordinate into a beautiful string.
+
+    Arguments:
+        coord {[float, float]} -- Pair of latitude and longitude.
+    Keyword Arguments:
+        n {int} -- Number of decimal places after the period (default: 6).
+    Returns:
+        string -- Formatted string of the lat-long pair.
+    '''
+    try:
+        if isinstance(coord[0], float) and isinstance(coord[1], float):
+            return str(format(coord[0], '.' + str(n) + 'f') + ',' + format(coord[1], '.' + str(n) + 'f'))
+    except Exception as e:
+        return False
+
+
+def splitCoords(text):
+    '''Splits a string that represents a coordinate into a list of floats
+
+    Arguments:
+        text {string} -- The lat/long pair in string format, e.g.: ' 35.281374, 139.663600  '
+
+    Returns:
+        list -- A pair of floats, one for latitude and one for longitude.
+        boolean -- False, if not a valid coordinate.
+    '''
+    try:
+        match = re.search('^https://maps.google.com/maps\?q=(.+)$', text)
+        if match:
+            coord = match[1]
+            coord = [float(x.strip()) for x in coord.split(',')]
+        else:
+            coord = [float(x.strip()) for x in text.split(',')]
+        if not isinstance(coord[0], float) or not isinstance(coord[1], float):
+            raise 'Not a coordinate'
+    except:
+        return False
+    else:
+        return coord
+
+
+# Same as gpxpy.geo
+EARTH_RADIUS = 6378.137 * 1000
+
+# (distance in km, cooldown in minutes) breakpoints: any distance from
+# one breakpoint up to the next one has that breakpoint's cooldown.
+COOLDOWN_TABLE = [
+    (1, 0.8),
+    (2, 1),
+    (3, 2),
+    (4, 2),
+    (5, 3),
+    (6, 4),
+    (10, 6),
+    (15, 8),
+    (20, 11),
+    (25, 14),
+    (30, 16),
+    (35, 17),
+    (40, 18),
+    (45, 19),
+    (50, 20),
+    (60, 21),
+    (70, 22),
+    (80, 23),
+    (90, 24),
+    (100, 26),
+    (125, 28),
+    (150, 31),
+    (175, 33),
+    (201, 36),
+    (250, 41),
+    (300, 46),
+    (328, 48),
+    (350, 49),
+    (400, 54),
+    (450, 58),
+    (500, 61),
+    (550, 65),
+    (600, 69),
+    (650, 73),
+    (700, 76),
+    (751, 81),
+    (802, 83),
+    (839, 88),
+    (897, 90),
+    (948, 94),
+    (1007, 97),
+    (1020, 101),
+    (1180, 109),
+    (1221, 112),
+    (1300, 117),
+    (1344, 119),
+    (1403, 120),
+    (1500, 120),
+]
+COOLDOWN_KM = np.array([km for km, minutes in COOLDOWN_TABLE], dtype=float)
+# Index 0 is anything below the first breakpoint.
+COOLDOWN_MINUTES = [0] + [minutes for km, minutes in COOLDOWN_TABLE]
+COOLDOWN_MINUTES_ARRAY = np.array(COOLDOWN_MINUTES, dtype=float)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''Exactly gpxpy.geo.haversine_distance, in plain python.'''
+    d_lon = math.radians(lon1 - lon2)
+    lat1 = math.radians(lat1)
+    lat2 = math.radians(lat2)
+    d_lat = lat1 - lat2
+    a = math.pow(math.sin(d_lat / 2), 2) + math.pow(math.sin(d_lon / 2), 2) * math.cos(lat1) * math.cos(lat2)
+    return EARTH_RADIUS * 2 * math.asin(math.sqrt(a))
+
+
+def calculateArray(lat1, lon1, lat2, lon2):
+    '''Vectorized calculate, arguments are broadcast against each other
+    like any numpy operation.
+
+    Returns:
+        ndarray -- The distances in kilometers, rounded to two decimal places.
+    '''
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (lat1, lon1, lat2, lon2)])
+    d_lon = np.radians(lon1 - lon2)
+    rlat1 = np.radians(lat1)
+    rlat2 = np.radians(lat2)
+    d_lat = rlat1 - rlat2
+    a = np.sin(d_lat / 2) ** 2 + np.sin(d_lon / 2) ** 2 * np.cos(rlat1) * np.cos(rlat2)
+    dist = np.asarray(EARTH_RADIUS * 2 * np.arcsin(np.sqrt(a)) / 1000)
+    rounded = np.asarray(np.round(dist, 2))
+
+    # numpy's trig and rounding can land on the other side of a .005 tie
+    # than math and round() do, so redo those few close calls the slow way.
+    close = np.abs((dist * 100) % 1 - 0.5) < 1e-6
+    for i in map(tuple, np.argwhere(close)):
+        rounded[i] = round(haversine(lat1[i], lon1[i], lat2[i], lon2[i]) / 1000, 2)
+    return rounded
+
+
+def calculateMatrix(coords):
+    '''Distances between every pair of coords.
+
+    Arguments:
+        coords {ndarray} -- N x 2 array of latitudes and longitudes.
+
+    Returns:
+        ndarray -- N x N distances in kilometers, as in calculate.
+    '''
+    coords = np.asarray(coords, dtype=float)
+    return calculateArray(coords[:, None, 0], coords[:, None, 1], coords[None, :, 0], coords[None, :, 1])
+
+
+def calculate(lat1, lon1, lat2, lon2):
+    '''Calculates the Harvesian distance between two coordinates
+
+    Returns:
+        float -- The distance in kilometers, rounded to two decimal places.
+    '''
+    return float(calculateArray(lat1, lon1, lat2, lon2))
+
+
+def cooldownIndex(dist):
+    '''Index into COOLDOWN_MINUTES of the cooldown for dist (scalar or array).'''
+    index = np.searchsorted(COOLDOWN_KM, dist, side='right')
+    # NaN sorts after everything, but it's no distance at all.
+    return np.where(np.isnan(dist), 0, index)
+
+
+def calculateCDArray(dist):
+    '''Vectorized calculateCD.
+
+    Returns:
+        ndarray -- The cooldowns in minutes.
+    '''
+    return COOLDOWN_MINUTES_ARRAY[cooldownIndex(np.asarray(dist, dtype=float))]
+
+
+def calculateCD(dist):
+    return COOLDOWN_MINUTES[int(cooldownIndex(dist))]
+
+
+class CooldownModel(object):
+    '''Knows where and when the last spin happened, and how long to
+    wait before the next one, according to a distance -> cooldown table.
+
+    Lookups are a bisect over plain lists and the distance is computed
+    with plain math, so asking is cheap enough to do all the time.
+
+    Keyword Arguments:
+        table {list} -- (km, minutes) breakpoints, like COOLDOWN_TABLE.
+        margin {float} -- Multiplies every cooldown, to be on the safe side (default: 1).
+        min_wait {float} -- Seconds to always leave between spins (default: 0).
+    '''
+    def __init__(self, table=COOLDOWN_TABLE, margin=1, min_wait=0):
+        self.km = [km for km, minutes in table]
+        self.minutes = [0] + [minutes for km, minutes in table]
+        self.margin = margin
+        self.min_wait = min_wait
+        self.last_lat = None
+        self.last_lng = None
+        self.last_spin_at = None
+
+    def cooldown_minutes(self, dist):
+        '''Same as calculateCD, for this model's table.'''
+        return self.minutes[bisect_right(self.km, dist)]
+
+    def record_spin(self, coords, at=None):
+        self.last_lat, self.last_lng = coords[0], coords[1]
+        self.last_spin_at = time.time() if at is None else at
+
+    def cooldown(self, coords):
+        '''Seconds that must pass between the last spin and one at coords.'''
+        if self.last_spin_at is None:
+            return 0
+        dist = round(haversine(self.last_lat, self.last_lng, coords[0], coords[1]) / 1000, 2)
+        return max(self.min_wait, self.cooldown_minutes(dist) * 60 * self.margin)
+
+    def legal_at(self, coords):
+        '''Earliest timestamp a spin at coords won't break the cooldown, or None if any time will do.'''
+        if self.last_spin_at is None:
+            return None
+        return self.last_spin_at + self.cooldown(coords)
+
+    def seconds_until_legal(self, coords, now=None):
+        if self.last_spin_at is None:
+            return 0
+        now = time.time() if now is None else now
+        return max(0, self.last_spin_at + self.cooldown(coords) - now)
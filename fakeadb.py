@@ -0,0 +1,467 @@
+#!/usr/bin/env python3.7
+'''A stand-in for adb that simulates phones running the game, so the
+bot can be run and benchmarked without any hardware.
+
+Put an executable called adb first on PATH that runs this file:
+
+    #!/bin/sh
+    exec python3 /path/to/fakeadb.py "$@"
+
+Everything else is set through environment variables:
+
+    FAKEADB_DIR                Where the simulated devices keep their state (required).
+    FAKEADB_DEVICES            Comma separated device ids (default: fake0).
+    FAKEADB_CONFIG             Config with the locations of everything (default: config.yaml).
+    FAKEADB_FRAMES             Directory of recorded screenshots, <screen>.png, to replay
+                               instead of drawing the screens (see SCREENS).
+    FAKEADB_SIZE               Screen size when drawing them (default: 1080x2160).
+    FAKEADB_INPUT_LATENCY      Seconds each `input` command takes (default: 0.05). Touches
+                               through the fake minitouch daemon don't pay it.
+    FAKEADB_SCREENCAP_LATENCY  Seconds each screenshot takes (default: 0.05).
+    FAKEADB_LOAD_SECONDS       Seconds the map takes to load after a teleport (default: 2).
+    FAKEADB_GPS_SECONDS        Seconds before `dumpsys location` reports where a teleport
+                               went (default: 0.3).
+    FAKEADB_PROMPT_RATE        Chance of the passenger prompt showing up after a teleport (default: 0).
+'''
+import fcntl
+import io
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import struct
+import sys
+import time
+from colorsys import hsv_to_rgb
+from contextlib import contextmanager
+
+import yaml
+from PIL import Image, ImageDraw, ImageFont
+
+SCREENS = ['loading', 'world', 'passenger', 'egg', 'menu', 'pokestop_blue', 'pokestop_purple', 'quests', 'encounter']
+
+BACKGROUNDS = {
+    'loading': (250, 250, 250),
+    'world': (120, 190, 110),
+    'passenger': (60, 90, 80),
+    'egg': (230, 240, 250),
+    'menu': (240, 240, 240),
+    'pokestop_blue': (60, 130, 230),
+    'pokestop_purple': (180, 90, 230),
+    'quests': (245, 245, 245),
+    'encounter': (140, 200, 140),
+}
+
+# What each screen shows in which config box.
+TEXTS = {
+    'passenger': ('im_a_passenger_button_box', "I'M A PASSENGER"),
+    'egg': ('oh_hatching_box', 'Oh?'),
+    'menu': ('shop_button_text_box', 'SHOP'),
+    'quests': ('claim_reward_box', 'CLAIM REWARD!'),
+}
+
+RE_TELEPORT = re.compile(r"TELEPORT --ef lat (\S+) --ef lng (\S+)")
+
+DIRECTORY = os.environ.get('FAKEADB_DIR')
+DEVICES = os.environ.get('FAKEADB_DEVICES', 'fake0').split(',')
+INPUT_LATENCY = float(os.environ.get('FAKEADB_INPUT_LATENCY', 0.05))
+SCREENCAP_LATENCY = float(os.environ.get('FAKEADB_SCREENCAP_LATENCY', 0.05))
+LOAD_SECONDS = float(os.environ.get('FAKEADB_LOAD_SECONDS', 2))
+GPS_SECONDS = float(os.environ.get('FAKEADB_GPS_SECONDS', 0.3))
+PROMPT_RATE = float(os.environ.get('FAKEADB_PROMPT_RATE', 0))
+
+
+def hue_color(hue):
+    '''RGB of a hue in PIL's 0-255 scale.'''
+    return tuple(int(c * 255) for c in hsv_to_rgb(hue / 255, 0.75, 0.9))
+
+
+def load_config():
+    with open(os.environ.get('FAKEADB_CONFIG', 'config.yaml'), 'r') as f:
+        return yaml.safe_load(f)
+
+
+def render(screen, config, size=None, progress=1):
+    '''Returns the screenshot of a screen: the recorded one if there's
+    one in FAKEADB_FRAMES, a drawing of it otherwise.
+
+    The loading screen fills up from left to right as progress goes
+    from 0 to 1, so it keeps changing until the map shows up, like
+    the real one does.
+    '''
+    frames = os.environ.get('FAKEADB_FRAMES')
+    if frames and os.path.exists(os.path.join(frames, screen + '.png')):
+        return Image.open(os.path.join(frames, screen + '.png')).convert('RGB')
+
+    if size is None:
+        size = [int(x) for x in os.environ.get('FAKEADB_SIZE', '1080x2160').split('x')]
+    im = Image.new('RGB', size, BACKGROUNDS[screen])
+    draw = ImageDraw.Draw(im)
+    locations = config['locations']
+    if screen == 'loading':
+        draw.rectangle([0, 0, int(size[0] * progress), size[1]], fill=(40, 40, 60))
+    if screen.startswith('pokestop'):
+        draw.rectangle(locations['bottom_pokestop_bar'], fill=hue_color(130 if screen == 'pokestop_blue' else 200))
+    if screen in TEXTS:
+        location, text = TEXTS[screen]
+        x1, y1, x2, y2 = locations[location]
+        draw.rectangle([x1, y1, x2, y2], fill=(255, 255, 255))
+        try:
+            font = ImageFont.load_default(size=(y2 - y1) * 0.6)
+        except TypeError:
+            font = ImageFont.load_default()
+        draw.text((x1 + 10, y1 + (y2 - y1) * 0.15), text, fill=(30, 30, 30), font=font)
+    return im
+
+
+def dumpsys_location(coords):
+    '''What `dumpsys location` says when the phone is at coords (or
+    doesn't know where it is, if None): like on a real phone, every
+    provider shows up several times, fine and coarse (about 2km off).
+    '''
+    def location(provider, lat, lng, accuracy):
+        return 'Location[{} {:.6f},{:.6f} hAcc={} et=+1s mock]'.format(provider, lat, lng, accuracy)
+
+    lines = ['Location Manager State:']
+    for provider in ('gps', 'network', 'passive'):
+        lines.append('  {} provider:'.format(provider))
+        lines.append('    enabled=true')
+        if coords is not None:
+            lines.append('    last location=' + location(provider, coords[0], coords[1], 5))
+            lines.append('    last coarse location=' + location(provider, coords[0] + 0.0176, coords[1], 2000))
+    lines.append('  Last Known Locations:')
+    if coords is not None:
+        for provider in ('gps', 'network', 'passive'):
+            lines.append('    {}: {}'.format(provider, location(provider, coords[0], coords[1], 5)))
+    lines.append('  Last Known Locations Coarse Intervals:')
+    if coords is not None:
+        for provider in ('gps', 'network', 'passive'):
+            lines.append('    {}: {}'.format(provider, location(provider, coords[0] + 0.0176, coords[1], 2000)))
+    lines.append('  Geofences:')
+    return '\n'.join(lines) + '\n'
+
+
+def stop_key(state):
+    '''Where the phone is, or None before the first teleport.'''
+    return '{:.6f},{:.6f}'.format(*state['coords']) if state['coords'] else None
+
+
+class FakeOcr(object):
+    '''Stands in for ocr.OcrPool where Tesseract isn't installed: reads
+    the texts this simulator draws by matching their fingerprints.
+    '''
+    def __init__(self, config, match=0.9):
+        from states import fingerprint
+        self.fingerprint = fingerprint
+        self.match = match
+        self.texts = []
+        for screen, (location, text) in TEXTS.items():
+            crop = render(screen, config).crop(config['locations'][location])
+            self.texts.append((self.fingerprint(crop), text))
+
+    async def image_to_string(self, im):
+        vector = self.fingerprint(im)
+        if vector is None:
+            return ''
+        score, text = max((float(vector.dot(reference)), text) for reference, text in self.texts)
+        return text if score >= self.match else ''
+
+    async def images_to_strings(self, ims):
+        return [await self.image_to_string(im) for im in ims]
+
+    def close(self):
+        pass
+
+
+class Device(object):
+    '''The state of one simulated phone, kept in a JSON file so every
+    fake adb process sees the same phone.
+    '''
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.path = os.path.join(DIRECTORY, device_id)
+        os.makedirs(self.path, exist_ok=True)
+        self.state = None
+
+    @contextmanager
+    def locked(self):
+        with open(os.path.join(self.path, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(os.path.join(self.path, 'state.json'), 'r') as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError):
+                self.state = {'screen': 'world', 'coords': None, 'teleported_at': 0, 'spun': [],
+                              'inputs': 0, 'screencaps': 0, 'spins': 0, 'claims': 0}
+            yield self.state
+            # Moved in place so readers that don't take the lock, like
+            # the tests, never see it half written.
+            path = os.path.join(self.path, 'state.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.state, f)
+            os.replace(path + '.tmp', path)
+
+    def screen(self):
+        '''Returns:
+            {tuple} -- The screen showing right now, and how far along it is.
+        '''
+        with self.locked() as state:
+            progress = (time.time() - state['teleported_at']) / LOAD_SECONDS if LOAD_SECONDS else 1
+            if state['screen'] == 'loading' and progress >= 1:
+                state['screen'] = 'passenger' if random.random() < PROMPT_RATE else 'world'
+            state['screencaps'] += 1
+            return state['screen'], min(progress, 1)
+
+    def screenshot(self):
+        time.sleep(SCREENCAP_LATENCY)
+        screen, progress = self.screen()
+        return render(screen, load_config(), progress=progress)
+
+    def log(self, tag, message):
+        with open(os.path.join(self.path, 'logcat.txt'), 'a') as f:
+            f.write('I/{}( 1234): {}\n'.format(tag, message))
+
+    def shell(self, cmd):
+        '''Runs a shell command line, returns (exit code, output).'''
+        if ';' in cmd:
+            results = [self.shell(part) for part in cmd.split(';')]
+            return results[-1][0], ''.join(output for code, output in results)
+        words = cmd.split()
+        if not words:
+            return 0, ''
+        if words[0] == 'sleep':
+            time.sleep(float(words[1]))
+            return 0, ''
+        if words[:2] == ['wm', 'size']:
+            im = render('world', load_config())
+            return 0, 'Physical size: {}x{}\n'.format(*im.size)
+        if words[:2] == ['dumpsys', 'location']:
+            with self.locked() as state:
+                arrived = time.time() - state['teleported_at'] >= GPS_SECONDS
+                coords = state['coords'] if arrived else state.get('previous_coords')
+            return 0, dumpsys_location(coords)
+        if words[0] == 'pidof':
+            return 0, '1234\n'
+        if words[0] == 'screencap' and len(words) > 2:
+            self.screenshot().save(os.path.join(self.path, 'screen.png'))
+            return 0, ''
+        if words[0] == 'input':
+            time.sleep(INPUT_LATENCY)
+            with self.locked() as state:
+                state['inputs'] += 1
+                if words[1] == 'tap':
+                    self.tap(state, int(words[2]), int(words[3]))
+                elif words[1] == 'swipe':
+                    self.swipe(state)
+            if words[1] == 'swipe' and len(words) > 6:
+                time.sleep(int(words[6]) / 1000)
+            return 0, ''
+        if words[0] == 'am':
+            match = RE_TELEPORT.search(cmd)
+            with self.locked() as state:
+                if match:
+                    state['previous_coords'] = state['coords']
+                    state['coords'] = [float(match.group(1)), float(match.group(2))]
+                    state['teleported_at'] = time.time()
+                    state['screen'] = 'loading'
+                elif 'clipper.get' in cmd:
+                    self.log('ClipboardReceiver', 'Clipboard text: {},{}'.format(*(state['coords'] or [0, 0])))
+            return 0, ''
+        return 0, ''
+
+    def tap(self, state, x, y):
+        locations = load_config()['locations']
+
+        def hit(location):
+            box = locations[location]
+            if len(box) == 2:
+                return abs(x - box[0]) <= 40 and abs(y - box[1]) <= 40
+            return box[0] <= x <= box[2] and box[1] <= y <= box[3]
+
+        screen = state['screen']
+        stop = stop_key(state)
+        if screen == 'world' and hit('pokestop'):
+            state['screen'] = 'pokestop_purple' if stop in state['spun'] else 'pokestop_blue'
+        elif screen == 'world' and hit('quest_button'):
+            state['screen'] = 'quests'
+        elif screen in ('passenger', 'egg') and hit('im_a_passenger_button_box'):
+            state['screen'] = 'world'
+        elif screen == 'quests' and hit('claim_reward_box'):
+            state['claims'] += 1
+            state['screen'] = 'encounter'
+        elif screen == 'encounter' and hit('exit_encounter'):
+            state['screen'] = 'world'
+        elif hit('x_button') and screen != 'loading':
+            state['screen'] = 'world'
+
+    def swipe(self, state):
+        if state['screen'] == 'pokestop_blue':
+            state['spins'] += 1
+            state['spun'].append(stop_key(state))
+            state['screen'] = 'pokestop_purple'
+
+    def forward(self):
+        '''Picks a free local port for `adb forward tcp:0 localabstract:minitouch`.'''
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        # Written aside and moved in place, so the daemon never reads a
+        # half written file.
+        path = os.path.join(self.path, 'minitouch.port')
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(port))
+        os.replace(path + '.tmp', path)
+        return port
+
+    def remove_forward(self, local):
+        path = os.path.join(self.path, 'minitouch.port')
+        try:
+            with open(path) as f:
+                if 'tcp:' + f.read().strip() == local:
+                    os.remove(path)
+        except OSError:
+            pass
+
+    def minitouch(self, max_x=4095, max_y=4095):
+        '''A minitouch daemon, listening on the forwarded port. Unlike
+        `input`, touches cost no FAKEADB_INPUT_LATENCY.
+        '''
+        path = os.path.join(self.path, 'minitouch.port')
+        port = None
+        for _ in range(100):
+            try:
+                with open(path) as f:
+                    port = int(f.read())
+                break
+            except (OSError, ValueError):
+                time.sleep(0.05)
+        if port is None:
+            sys.exit('minitouch: nothing forwarded to localabstract:minitouch')
+        width, height = render('world', load_config()).size
+        server = socket.socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', port))
+        server.listen(1)
+        while True:
+            connection, address = server.accept()
+            connection.sendall('v 1\n^ 10 {} {} 255\n$ {}\n'.format(max_x, max_y, os.getpid()).encode())
+            down = last = None
+            for line in connection.makefile('r'):
+                words = line.split()
+                if words[:1] == ['d']:
+                    down = last = (int(words[2]) * width // max_x, int(words[3]) * height // max_y)
+                elif words[:1] == ['m']:
+                    last = (int(words[2]) * width // max_x, int(words[3]) * height // max_y)
+                elif words[:1] == ['w']:
+                    time.sleep(int(words[1]) / 1000)
+                elif words[:1] == ['u'] and down is not None:
+                    with self.locked() as state:
+                        state['inputs'] += 1
+                        if abs(last[0] - down[0]) + abs(last[1] - down[1]) > 50:
+                            self.swipe(state)
+                        else:
+                            self.tap(state, *down)
+                    down = None
+            connection.close()
+
+    def logcat(self):
+        path = os.path.join(self.path, 'logcat.txt')
+        open(path, 'a').close()
+        with open(path, 'r') as f:
+            f.seek(0, io.SEEK_END)
+            # Only once attached, like the real one.
+            sys.stdout.write('--------- beginning of main\n')
+            sys.stdout.flush()
+            while True:
+                line = f.readline()
+                if line:
+                    sys.stdout.write(line)
+                else:
+                    sys.stdout.write('D/Noise( 999): nothing to see here\n')
+                    sys.stdout.flush()
+                    time.sleep(0.05)
+
+
+def write_raw(im):
+    sys.stdout.buffer.write(struct.pack('<4I', im.size[0], im.size[1], 1, 0) + im.convert('RGBA').tobytes())
+    sys.stdout.buffer.flush()
+
+
+def exec_out(device, cmd):
+    if cmd == 'screencap -p':
+        device.screenshot().save(sys.stdout.buffer, 'PNG')
+    elif cmd == 'screencap':
+        write_raw(device.screenshot())
+    elif 'while' in cmd and 'screencap' in cmd:
+        while True:
+            write_raw(device.screenshot())
+    else:
+        return 1
+    return 0
+
+
+def interactive_shell(device):
+    '''A persistent `adb shell`: one command line per stdin line.'''
+    code = 0
+    for line in sys.stdin:
+        line = line.strip()
+        if line.startswith('echo '):
+            sys.stdout.write(line[5:].replace('$?', str(code)) + '\n')
+        else:
+            code, output = device.shell(line)
+            sys.stdout.write(output)
+        sys.stdout.flush()
+    return 0
+
+
+def main(argv):
+    if DIRECTORY is None:
+        sys.stderr.write('FAKEADB_DIR is not set\n')
+        return 1
+    if argv[:1] == ['devices']:
+        sys.stdout.write('List of devices attached\n' + ''.join('{}\tdevice\n'.format(d) for d in DEVICES) + '\n')
+        return 0
+    if argv[:1] == ['-s']:
+        device_id, argv = argv[1], argv[2:]
+    else:
+        device_id = DEVICES[0]
+    if device_id not in DEVICES:
+        sys.stderr.write("error: device '{}' not found\n".format(device_id))
+        return 1
+    device = Device(device_id)
+
+    command, args = argv[0], argv[1:]
+    if command == 'shell':
+        if not args:
+            return interactive_shell(device)
+        if args[0].endswith('/minitouch'):
+            device.minitouch()
+            return 0
+        code, output = device.shell(' '.join(args))
+        sys.stdout.write(output)
+        return code
+    if command == 'exec-out':
+        return exec_out(device, ' '.join(args))
+    if command == 'forward' and args[1:] == ['localabstract:minitouch']:
+        sys.stdout.write('{}\n'.format(device.forward()))
+        return 0
+    if command == 'forward' and args[:1] == ['--remove']:
+        device.remove_forward(args[1])
+        return 0
+    if command == 'pull':
+        shutil.copy(os.path.join(device.path, 'screen.png'), args[1])
+        return 0
+    if command == 'logcat':
+        device.logcat()
+        return 0
+    sys.stderr.write('fakeadb: unknown command {}\n'.format(command))
+    return 1
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except (BrokenPipeError, KeyboardInterrupt):
+        sys.exit(0)
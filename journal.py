@@ -0,0 +1,128 @@
+'''Append-only journal of a run, so a restart picks up where the last
+one left off instead of spinning everything again from stop 1.
+
+Every line is a JSON record of one action (teleport, spin, claim)
+that also carries the whole state of the run right after it: which
+stop we're on, the quest progress and the last spin. Resuming then
+only needs the last complete line, which is read from the end of the
+file no matter how long the run has been going.
+'''
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('journal')
+
+
+class Journal(object):
+    '''A run journal backed by a file.
+
+    Lines are handed to the OS right away, so they survive the bot
+    crashing, but only fsynced every few records or seconds, so they
+    survive the machine crashing too without paying a disk flush per
+    tap.
+
+    Arguments:
+        filename {str} -- Where the journal lives.
+
+    Keyword Arguments:
+        sync_every {int} -- Records between fsyncs (default: 16).
+        sync_seconds {float} -- Seconds between fsyncs (default: 5).
+        compact_bytes {int} -- Size after which the file is rewritten down
+                               to its last record (default: 1MB).
+    '''
+    def __init__(self, filename, sync_every=16, sync_seconds=5, compact_bytes=1 << 20):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        self.compact_bytes = compact_bytes
+        self.file = None
+        self.unsynced = 0
+        self.synced_at = time.time()
+        self.state = None
+
+    def load(self):
+        '''Returns:
+            {dict} -- The state after the last complete record.
+            {None} -- If there's no journal yet.
+        '''
+        try:
+            with open(self.filename, 'rb') as f:
+                self.state = last_record(f)
+        except FileNotFoundError:
+            self.state = None
+        return self.state
+
+    def append(self, event, **state):
+        '''Records that event just happened, leaving the run in state.'''
+        if self.file is None:
+            self.file = open(self.filename, 'a+')
+            if self.file.tell() > 0:
+                self.file.seek(self.file.tell() - 1)
+                if self.file.read(1) != '\n':
+                    # Finish off a line cut short by a crash.
+                    self.file.write('\n')
+        self.state = dict(state, event=event, at=time.time())
+        self.file.write(json.dumps(self.state, separators=(',', ':')) + '\n')
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.time() - self.synced_at >= self.sync_seconds:
+            self.sync()
+        if self.file.tell() >= self.compact_bytes:
+            self.compact()
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def compact(self):
+        '''Rewrites the journal down to its last record.'''
+        self.close()
+        if self.state is not None:
+            with open(self.filename + '.tmp', 'w') as f:
+                f.write(json.dumps(self.state, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.filename + '.tmp', self.filename)
+            logger.debug('Compacted %s', self.filename)
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+
+def last_record(f, block_size=4096):
+    '''Parses the last complete line of a journal, reading backwards
+    from the end until it finds one. Lines cut short by a crash are
+    skipped.
+
+    Arguments:
+        f {file} -- The journal, opened in binary mode.
+
+    Returns:
+        {dict} -- The last record, or None if there isn't any.
+    '''
+    end = f.seek(0, os.SEEK_END)
+    size = block_size
+    while True:
+        start = max(0, end - size)
+        f.seek(start)
+        lines = f.read(end - start).split(b'\n')
+        if start > 0:
+            # Probably starts mid-line.
+            lines = lines[1:]
+        for line in reversed(lines):
+            if not line.strip():
+                continue
+            try:
+                return json.loads(line.decode('utf-8'))
+            except ValueError:
+                logger.warning('Skipping a broken journal line: %r', line[:80])
+        if start == 0:
+            return None
+        size *= 2
@@ -0,0 +1,85 @@
+'''OCR off the event loop.
+
+Tesseract runs in a pool of worker processes that keep their OCR
+handles warm between calls, so recognizing a box neither blocks the
+event loop nor pays the tool setup every time. Results are memoized
+by the crop's contents, so identical crops skip OCR entirely.
+'''
+import asyncio
+import collections
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from tracing import tracer
+
+logger = logging.getLogger('ocr')
+
+# Every letter we ever look for: CLAIM REWARD PASSENGER SHOP Oh?
+WHITELIST = "ACDEGHILMNOPRSWh? "
+
+# Warm handles, one set per worker process.
+_api = None
+_tool = None
+_builder = None
+
+
+def _init_worker(whitelist):
+    global _api, _tool, _builder
+    try:
+        import tesserocr
+        _api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_LINE)
+        _api.SetVariable('tessedit_char_whitelist', whitelist)
+    except ImportError:
+        from pyocr import builders, pyocr
+        _tool = pyocr.get_available_tools()[0]
+        _builder = builders.TextBuilder(tesseract_layout=7)  # single line
+        _builder.tesseract_flags += ['-c', 'tessedit_char_whitelist=' + whitelist]
+
+
+def _recognize(im):
+    if _api is not None:
+        _api.SetImage(im)
+        text = _api.GetUTF8Text()
+    else:
+        text = _tool.image_to_string(im, builder=_builder)
+    return text.replace("\n", " ").strip()
+
+
+class OcrPool(object):
+    '''A pool of OCR worker processes.
+
+    Keyword Arguments:
+        workers {int} -- Number of worker processes (default: 2).
+        whitelist {str} -- Characters Tesseract is allowed to return.
+        cache_size {int} -- How many crop results to remember (default: 256).
+    '''
+    def __init__(self, workers=2, whitelist=WHITELIST, cache_size=256):
+        self.executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(whitelist,))
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    async def image_to_string(self, im):
+        key = (im.mode, im.size, hashlib.blake2b(im.tobytes(), digest_size=16).digest())
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.misses += 1
+        with tracer.span('ocr', size=im.size):
+            text = await asyncio.get_event_loop().run_in_executor(self.executor, _recognize, im)
+        self.cache[key] = text
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return text
+
+    async def images_to_strings(self, ims):
+        '''Recognizes many crops in parallel, returning their texts in the same order.'''
+        return await asyncio.gather(*[self.image_to_string(im) for im in ims])
+
+    def close(self):
+        logger.debug('OCR cache: %d hits, %d misses', self.hits, self.misses)
+        self.executor.shutdown(wait=False)
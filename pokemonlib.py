@@ -1,11 +1,16 @@
 from io import BytesIO
 from PIL import Image
 import asyncio
+import collections
 import logging
-import subprocess
 import re
+import struct
+import time
 from colorlog import ColoredFormatter
 
+from cooldown import haversine
+from tracing import tracer
+
 
 logger = logging.getLogger('PokemonGo')
 logger.setLevel(logging.INFO)
@@ -15,7 +20,129 @@ formatter = ColoredFormatter("  %(log_color)s%(levelname)-8s%(reset)s | %(log_co
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
+RE_WM_SIZE = re.compile(r"(Physical|Override) size: (\d+)x(\d+)")
 RE_CLIPBOARD_TEXT = re.compile(r"^./ClipboardReceiver\(\s*\d+\): Clipboard text: (.+)$")
+# e.g. "gps: Location[gps 35.281374,139.663600 hAcc=5 et=+1d2h mock]" in `dumpsys location`
+RE_LOCATION = re.compile(r"Location\[(\w+) (-?\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?)")
+
+# PixelFormat values of `screencap` raw output and the matching PIL raw modes.
+# RGBX is read as RGBA so PIL can map the buffer as-is, X is just ignored later on.
+RAW_SCREENCAP_FORMATS = {
+    1: 'RGBA',  # PIXEL_FORMAT_RGBA_8888
+    2: 'RGBA',  # PIXEL_FORMAT_RGBX_8888
+    5: 'BGRA',  # PIXEL_FORMAT_BGRA_8888
+}
+
+def parse_raw_screencap(data):
+    '''Parses the output of `screencap` (without -p).
+
+    The header is width, height and pixel format as little endian
+    uint32s, followed by the dataspace on Android 9+ (so either 12
+    or 16 bytes), then the 4 bytes per pixel framebuffer itself.
+
+    Arguments:
+        data {bytes} -- Raw screencap output.
+
+    Returns:
+        {tuple} -- (width, height, rawmode, pixels), where pixels is a
+                   memoryview over data, so nothing gets copied.
+
+    Raises:
+        TruncatedScreencapError -- If data is shorter than its header says.
+        ValueError -- If the header or pixel format isn't one we know.
+    '''
+    if len(data) < 12:
+        raise TruncatedScreencapError("Raw screencap too short ({} bytes)".format(len(data)))
+    width, height, pixel_format = struct.unpack_from('<3I', data)
+    # Checked before the size, which only makes sense for 4 bytes per
+    # pixel: an RGB_565 frame would otherwise look cut short.
+    if pixel_format not in RAW_SCREENCAP_FORMATS:
+        raise ValueError("Unsupported raw screencap pixel format {}".format(pixel_format))
+    header_size = len(data) - width * height * 4
+    if header_size < 12:
+        raise TruncatedScreencapError("Raw screencap cut short ({} bytes for {}x{})".format(len(data), width, height))
+    if header_size not in (12, 16):
+        raise ValueError("Raw screencap size does not match {}x{}".format(width, height))
+    return width, height, RAW_SCREENCAP_FORMATS[pixel_format], memoryview(data)[header_size:]
+
+
+def crop_raw_screencap(width, height, rawmode, pixels, box):
+    '''Crops a box out of a parsed raw screencap, copying only the
+    rows/columns inside the box instead of building the full image.
+
+    Arguments:
+        width, height, rawmode, pixels -- As returned by parse_raw_screencap.
+        box {list} -- [x1, y1, x2, y2], like Image.crop.
+
+    Returns:
+        {Image} -- The cropped region, in RGBA mode.
+    '''
+    x1, y1, x2, y2 = box
+    x1, x2 = max(0, min(x1, width)), max(0, min(x2, width))
+    y1, y2 = max(0, min(y1, height)), max(0, min(y2, height))
+    stride = width * 4
+    start, end = x1 * 4, x2 * 4
+    data = b"".join(pixels[y * stride + start:y * stride + end] for y in range(y1, y2))
+    return Image.frombytes('RGBA', (x2 - x1, y2 - y1), data, 'raw', rawmode)
+
+
+def parse_dumpsys_location(text):
+    '''Picks the fine location of every provider out of `dumpsys location`.
+
+    Each provider can show up more than once: its own "last location="
+    comes first, the "last coarse location=" right after it, and older
+    Android versions repeat all of them, coarse and possibly stale, in
+    a "Coarse Intervals" block at the end. Only the first location of
+    every provider that isn't marked coarse is kept.
+
+    Returns:
+        {dict} -- Maps provider names to [lat, lng].
+    '''
+    locations = {}
+    coarse_block = None
+    for line in text.splitlines():
+        indent = len(line) - len(line.lstrip())
+        if coarse_block is not None and indent > coarse_block:
+            continue
+        coarse_block = None
+        if 'coarse' in line.lower():
+            if line.rstrip().endswith(':'):
+                # Skip everything nested under it.
+                coarse_block = indent
+            continue
+        match = RE_LOCATION.search(line)
+        if match:
+            locations.setdefault(match.group(1), [float(match.group(2)), float(match.group(3))])
+    return locations
+
+
+def adb_stage(args):
+    '''Names the tracing stage of an adb command line after its
+    subcommand, and the command it runs for shell, e.g. 'adb shell input'.
+    '''
+    args = [str(arg) for arg in args[1:]]
+    if args[:1] == ['-s']:
+        args = args[2:]
+    if args[:1] == ['shell'] and len(args) > 1:
+        return 'adb shell ' + args[1].split()[0]
+    return ' '.join(['adb'] + args[:1])
+
+
+def input_commands(steps):
+    '''Turns gesture steps (see Minitouch) into `input` command lines.'''
+    commands = []
+    for step in steps:
+        kind, args = step[0], step[1:]
+        if kind == 'tap':
+            commands.append(["input", "tap", *args])
+        elif kind == 'swipe':
+            commands.append(["input", "swipe", *args[:4]] + ([args[4]] if args[4] else []))
+        elif kind == 'wait':
+            commands.append(["sleep", args[0] / 1000])
+        else:
+            raise ValueError("Unknown gesture step {}".format(step))
+    return commands
+
 
 class CalcyIVError(Exception):
     # logger.error('CalcyIV did not find any combinations.')
@@ -33,17 +160,767 @@ class LogcatNotRunningError(Exception):
     # logger.error('For some reason, I can\'t run the logcat on your phone! :( Try to run \'adb logcat\' and see if something happens. Message the developers as well!')
     pass
 
+class FrameStreamNotRunningError(Exception):
+    # logger.error('The frame stream stopped, screenshots can\'t be read from it anymore.')
+    pass
+
+class TruncatedScreencapError(ValueError):
+    # logger.error('The screenshot got cut short, the phone might have been disconnected for a moment.')
+    pass
+
+class AdbTimeoutError(Exception):
+    # logger.error('adb took too long to answer, the phone might be frozen or disconnected.')
+    pass
+
+class MinitouchNotAvailableError(Exception):
+    # logger.error('minitouch is not running on the phone, push a build that matches its ABI to /data/local/tmp/minitouch.')
+    pass
+
+class AdbShell(object):
+    '''A long-lived `adb shell` session for a single device.
+
+    Commands are written to the shell's stdin, each followed by an
+    echo of a unique sentinel carrying the exit code, so we know
+    exactly where the output of a command ends without paying for a
+    new adb process every time. If the session dies (adb restarted,
+    phone reconnected...) it is transparently respawned.
+    '''
+    SENTINEL = "__PGOQ_DONE__"
+
+    def __init__(self, device_id, timeout=None):
+        self.device_id = device_id
+        self.timeout = timeout
+        self.process = None
+        self.counter = 0
+        self.lock = None
+
+    async def connect(self):
+        cmd = ["adb", "-s", self.device_id, "shell"]
+        logger.debug("Starting persistent shell %s", cmd)
+        self.process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+
+    async def close(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        self.process = None
+
+    async def run(self, cmd):
+        '''Runs cmd on the device shell.
+
+        Arguments:
+            cmd {string} -- The shell command line.
+
+        Returns:
+            {tuple} -- (return code, stdout, stderr), like PokemonGo.run.
+                       stderr is merged into stdout, so it is always b''.
+        '''
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            try:
+                try:
+                    return await asyncio.wait_for(self._run(cmd), self.timeout)
+                except (BrokenPipeError, ConnectionResetError, asyncio.IncompleteReadError):
+                    logger.warning("Persistent shell dropped, reconnecting...")
+                    await self.close()
+                    return await asyncio.wait_for(self._run(cmd), self.timeout)
+            except asyncio.TimeoutError:
+                # We don't know where the output of the stuck command ends
+                # anymore, so start over with a clean session next time.
+                await self.close()
+                raise AdbTimeoutError(cmd)
+
+    async def _run(self, cmd):
+        if self.process is None or self.process.returncode is not None:
+            await self.connect()
+
+        self.counter += 1
+        marker = "{}{}:".format(self.SENTINEL, self.counter).encode()
+        self.process.stdin.write(cmd.encode() + b"\necho " + marker + b"$?\n")
+        await self.process.stdin.drain()
+
+        output = b""
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                raise asyncio.IncompleteReadError(output, None)
+            index = line.find(marker)
+            if index == -1:
+                output += line
+                continue
+            output += line[:index]
+            return_code = int(line[index + len(marker):].strip() or -1)
+            logger.debug("Return code %d", return_code)
+            return (return_code, output, b"")
+
+
+class Minitouch(object):
+    '''Touch input through minitouch, a daemon that writes straight to
+    the touchscreen device, instead of `input tap`/`input swipe`, which
+    start a whole Java process on the phone for every single touch.
+
+    The daemon is started with `adb shell` and reached through an `adb
+    forward`ed socket. The binary matching the phone's ABI must be at
+    BINARY already (see https://github.com/DeviceFarmer/minitouch).
+
+    Gestures are lists of steps, all sent in a single write:
+        ('tap', x, y)                      -- press and release.
+        ('swipe', x1, y1, x2, y2, ms)      -- drag from one point to another.
+        ('wait', ms)                       -- pause between steps.
+    '''
+    BINARY = "/data/local/tmp/minitouch"
+
+    def __init__(self, device_id, resolution, pressure=50, step_ms=10, timeout=10):
+        self.device_id = device_id
+        self.width, self.height = (int(x) for x in resolution.split('x'))
+        self.pressure = pressure
+        self.step_ms = step_ms
+        self.timeout = timeout
+        self.daemon = None
+        self.port = None
+        self.reader = None
+        self.writer = None
+        self.max_x = self.max_y = None
+        self.max_pressure = None
+        self.lock = None
+
+    async def start(self):
+        '''Starts the daemon and connects to it.
+
+        Raises:
+            MinitouchNotAvailableError -- If it doesn't come up.
+        '''
+        self.daemon = await asyncio.create_subprocess_exec(
+            "adb", "-s", self.device_id, "shell", self.BINARY,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        p = await asyncio.create_subprocess_exec(
+            "adb", "-s", self.device_id, "forward", "tcp:0", "localabstract:minitouch",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await p.communicate()
+        try:
+            self.port = port = int(stdout.strip())
+        except ValueError:
+            await self.stop()
+            raise MinitouchNotAvailableError(stderr.decode('utf-8', errors='ignore').strip())
+
+        # The daemon takes a moment to start listening.
+        started = time.time()
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+                await asyncio.wait_for(self._read_header(), self.timeout)
+                break
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+                if self.writer is not None:
+                    self.writer.close()
+                    self.writer = None
+                if self.daemon.returncode is not None or time.time() - started > self.timeout:
+                    await self.stop()
+                    raise MinitouchNotAvailableError(e)
+                await asyncio.sleep(0.1)
+        logger.info("minitouch is up, touch area %dx%d", self.max_x, self.max_y)
+
+    async def _read_header(self):
+        # v <version>, ^ <max contacts> <max x> <max y> <max pressure>, $ <pid>
+        while True:
+            line = (await self.reader.readuntil(b'\n')).decode().split()
+            if line[:1] == ['^']:
+                self.max_x, self.max_y, self.max_pressure = int(line[2]), int(line[3]), int(line[4])
+            elif line[:1] == ['$']:
+                return
+
+    async def stop(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.daemon is not None and self.daemon.returncode is None:
+            self.daemon.kill()
+            await self.daemon.wait()
+        self.daemon = None
+        if self.port is not None:
+            p = await asyncio.create_subprocess_exec(
+                "adb", "-s", self.device_id, "forward", "--remove", "tcp:{}".format(self.port),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            await p.wait()
+            self.port = None
+
+    def _point(self, x, y):
+        return int(int(x) * self.max_x / self.width), int(int(y) * self.max_y / self.height)
+
+    def commands(self, steps):
+        '''Turns gesture steps into minitouch commands.
+
+        Returns:
+            {tuple} -- (commands, ms): the commands to send, and how long
+                       the phone takes to play them.
+        '''
+        pressure = min(self.pressure, self.max_pressure or self.pressure)
+        commands, total = [], 0
+        for step in steps:
+            kind, args = step[0], step[1:]
+            if kind == 'tap':
+                commands += ["d 0 {} {} {}".format(*self._point(*args), pressure), "c", "u 0", "c"]
+            elif kind == 'swipe':
+                x1, y1, x2, y2, ms = args
+                # Same as `input swipe` without a duration.
+                ms = 300 if ms is None else ms
+                (x1, y1), (x2, y2) = self._point(x1, y1), self._point(x2, y2)
+                moves = max(1, int(ms) // self.step_ms)
+                commands += ["d 0 {} {} {}".format(x1, y1, pressure), "c"]
+                for i in range(1, moves + 1):
+                    commands += ["w {}".format(int(ms) // moves),
+                                 "m 0 {} {} {}".format(x1 + (x2 - x1) * i // moves, y1 + (y2 - y1) * i // moves, pressure), "c"]
+                commands += ["u 0", "c"]
+                total += int(ms)
+            elif kind == 'wait':
+                commands.append("w {}".format(int(args[0])))
+                total += int(args[0])
+            else:
+                raise ValueError("Unknown gesture step {}".format(step))
+        return commands, total
+
+    async def gesture(self, steps):
+        '''Plays steps on the phone, returning once they're done.
+
+        Raises:
+            ConnectionError -- If the daemon or its socket went away.
+        '''
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        commands, ms = self.commands(steps)
+        async with self.lock:
+            if self.writer is None or self.daemon is None or self.daemon.returncode is not None:
+                raise ConnectionResetError("minitouch is not running")
+            self.writer.write(("\n".join(commands) + "\n").encode())
+            await self.writer.drain()
+            # minitouch doesn't say when it's done, but it plays them in real time.
+            await asyncio.sleep(ms / 1000)
+
+
+class FrameStream(object):
+    '''A continuous feed of raw screencap frames.
+
+    Keeps a single command open that writes raw screencaps back to
+    back (by default a `screencap` loop running on the device through
+    `adb exec-out`) and keeps the last few frames in a ring buffer, so
+    readers get the newest frame without an adb round trip each.
+
+    Any command producing concatenated raw screencaps works, e.g.
+    ['cat', 'recording.raw'] replays a recorded stream.
+
+    Keyword Arguments:
+        header_size {int} -- Bytes of header before every frame (default: 16).
+        depth {int} -- Number of frames kept in the ring buffer (default: 3).
+        reconnect {bool} -- Restart cmd when it ends (default: True).
+        timeout {float} -- Seconds wait_for_frame waits before raising
+                           AdbTimeoutError (default: wait forever).
+        max_reconnects {int} -- Restarts in a row that don't produce a
+                                single frame before giving up (default: 5).
+    '''
+    def __init__(self, cmd, header_size=16, depth=3, reconnect=True, timeout=None, max_reconnects=5):
+        self.cmd = cmd
+        self.header_size = header_size
+        self.frames = collections.deque(maxlen=depth)
+        self.reconnect = reconnect
+        self.timeout = timeout
+        self.max_reconnects = max_reconnects
+        self.process = None
+        self.task = None
+        self.frame_event = None
+        self.frames_read = 0
+
+    async def start(self):
+        self.frame_event = asyncio.Event()
+        self.task = asyncio.ensure_future(self._read_forever())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self._kill()
+
+    async def _kill(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        self.process = None
+
+    async def _read_forever(self):
+        failures = 0
+        try:
+            while True:
+                logger.debug("Starting frame stream %s", self.cmd)
+                frames_read = self.frames_read
+                self.process = await asyncio.create_subprocess_exec(
+                    *[str(arg) for arg in self.cmd],
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+                try:
+                    await self._read_frames(self.process.stdout)
+                except asyncio.IncompleteReadError:
+                    pass
+                await self._kill()
+                if not self.reconnect:
+                    logger.debug("Frame stream ended after %d frames", self.frames_read)
+                    return
+                failures = 0 if self.frames_read > frames_read else failures + 1
+                if failures >= self.max_reconnects:
+                    logger.error("Frame stream didn't produce a frame in %d tries, giving up", failures)
+                    return
+                logger.warning("Frame stream dropped, reconnecting...")
+                await asyncio.sleep(1)
+        finally:
+            # Wake up readers, to find out it's over.
+            self.frame_event.set()
+
+    async def _read_frames(self, stdout):
+        # The next frame is captured right after the previous one was
+        # written, so that's the earliest moment it can show.
+        captured_at = time.time()
+        while True:
+            header = await stdout.readexactly(self.header_size)
+            width, height, pixel_format = struct.unpack_from('<3I', header)
+            pixels = await stdout.readexactly(width * height * 4)
+            rawmode = RAW_SCREENCAP_FORMATS.get(pixel_format, 'RGBA')
+            self.frames.append((captured_at, (width, height, rawmode, memoryview(pixels))))
+            self.frames_read += 1
+            captured_at = time.time()
+            self.frame_event.set()
+            self.frame_event = asyncio.Event()
+
+    def latest(self):
+        '''Returns the newest (timestamp, frame) pair, or None if there's none yet.'''
+        return self.frames[-1] if self.frames else None
+
+    async def wait_for_frame(self, newer_than=0):
+        '''Returns the newest (timestamp, frame) pair captured at or after newer_than.
+
+        The frame is the same tuple returned by parse_raw_screencap.
+
+        Raises:
+            FrameStreamNotRunningError -- If the stream stopped for good.
+            AdbTimeoutError -- If no such frame came within self.timeout.
+        '''
+        started = time.time()
+        while not self.frames or self.frames[-1][0] < newer_than:
+            if self.task is None or self.task.done():
+                raise FrameStreamNotRunningError()
+            timeout = None if self.timeout is None else max(0, self.timeout - (time.time() - started))
+            try:
+                await asyncio.wait_for(self.frame_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise AdbTimeoutError(self.cmd)
+        return self.frames[-1]
+
+
+class CapturePipeline(object):
+    '''Captures the next frame while the current one is being looked at.
+
+    A background task keeps up to depth frames captured ahead, each
+    tagged with the time its capture started, so the phone link isn't
+    idle while the CPU analyzes a frame and vice versa. Frames from
+    before the last input, older than one already handed out or that
+    have been waiting longer than max_age since their capture finished
+    are thrown away, so decisions are never made on what the screen
+    looked like before it could have reacted. Age is counted from the
+    end of the capture so a phone slower than max_age still gets its
+    frames used.
+
+    Arguments:
+        capture {callable} -- Coroutine function returning a new frame.
+
+    Keyword Arguments:
+        depth {int} -- Frames to capture ahead (default: 1, double buffering).
+        max_age {float} -- Seconds after which an unused frame is too old (default: 1).
+    '''
+    def __init__(self, capture, depth=1, max_age=1.0):
+        self.capture = capture
+        self.depth = depth
+        self.max_age = max_age
+        self.frames = collections.deque()
+        self.task = None
+        self.frame_event = None
+        self.room_event = None
+        self.error = None
+        self.handed_out_at = 0
+        self.used = 0
+        self.stale = 0
+
+    async def start(self):
+        self.frame_event = asyncio.Event()
+        self.room_event = asyncio.Event()
+        self.error = None
+        self.task = asyncio.ensure_future(self._capture_forever())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.frames.clear()
+        logger.debug("Capture pipeline: %d frames used, %d stale", self.used, self.stale)
+
+    async def _capture_forever(self):
+        try:
+            while True:
+                while len(self.frames) >= self.depth:
+                    await self.room_event.wait()
+                    self.room_event = asyncio.Event()
+                captured_at = time.time()
+                frame = await self.capture()
+                self.frames.append((captured_at, time.time(), frame))
+                self.frame_event.set()
+                self.frame_event = asyncio.Event()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+            self.frame_event.set()
+
+    async def get(self, newer_than=0):
+        '''Returns the newest (timestamp, frame) pair captured after
+        newer_than (e.g. the last input) that is still fresh.
+
+        Raises whatever the capture raised, restarting it for next time.
+        '''
+        while True:
+            too_old = time.time() - self.max_age
+            while self.frames and (self.frames[0][0] < newer_than or self.frames[0][0] <= self.handed_out_at
+                                   or self.frames[0][1] < too_old):
+                self.frames.popleft()
+                self.stale += 1
+            # Only the newest of the fresh ones matters.
+            while len(self.frames) > 1:
+                self.frames.popleft()
+                self.stale += 1
+            self.room_event.set()
+            if self.frames:
+                captured_at, finished_at, frame = self.frames.popleft()
+                self.handed_out_at = captured_at
+                self.used += 1
+                return captured_at, frame
+            if self.error is not None:
+                error = self.error
+                await self.start()
+                raise error
+            await self.frame_event.wait()
+
+
+class LogcatSubscription(object):
+    '''Lines of logcat a LogcatDispatcher hands over to someone.
+
+    If nobody reads them, only the first maxsize are kept and the rest
+    are counted in dropped.
+    '''
+    def __init__(self, pattern=None, tag=None, maxsize=100):
+        self.pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+        self.tag = tag
+        self.queue = asyncio.Queue(maxsize)
+        self.received = 0
+        self.dropped = 0
+
+    def offer(self, line, tag):
+        if self.tag is not None and tag != self.tag:
+            return
+        if self.pattern is not None:
+            line = self.pattern.match(line)
+            if not line:
+                return
+        self.received += 1
+        try:
+            self.queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def close(self):
+        '''Wakes up readers with a LogcatNotRunningError.'''
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(None)
+
+    async def get(self):
+        '''Returns the next line, or its match object if subscribed with a pattern.'''
+        line = await self.queue.get()
+        if line is None:
+            # Put it back for whoever is waiting next.
+            self.queue.put_nowait(None)
+            raise LogcatNotRunningError()
+        return line
+
+    def drain(self):
+        while not self.queue.empty():
+            if self.queue.get_nowait() is None:
+                self.queue.put_nowait(None)
+                return
+
+
+class LogcatDispatcher(object):
+    '''Reads logcat in big chunks in the background and hands every
+    line to the subscriptions interested in it.
+
+    Keyword Arguments:
+        chunk_size {int} -- Bytes read at a time (default: 64KB).
+        timeout {float} -- Seconds start waits for logcat to print its
+                           first line (default: 10).
+    '''
+    def __init__(self, cmd, chunk_size=65536, timeout=10):
+        self.cmd = cmd
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.subscriptions = []
+        self.process = None
+        self.task = None
+        self.lines_read = 0
+
+    async def start(self):
+        logger.debug("Starting logcat %s", self.cmd)
+        self.process = await asyncio.create_subprocess_exec(
+            *self.cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        # Only once logcat prints something is it surely attached, and
+        # won't miss the reply to something sent right after this.
+        # The line itself is discarded, as -T 0 doesn't work.
+        try:
+            await asyncio.wait_for(self.process.stdout.readline(), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Logcat didn't print anything in %ss, it might miss the first lines", self.timeout)
+        self.task = asyncio.ensure_future(self._read_forever())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+
+    def subscribe(self, pattern=None, tag=None, maxsize=100):
+        '''Returns a LogcatSubscription to lines matching pattern (a regex)
+        and/or with the given tag, or to every line if neither is given.
+        '''
+        subscription = LogcatSubscription(pattern, tag, maxsize)
+        if self.task is not None and self.task.done():
+            subscription.close()
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.remove(subscription)
+
+    def drain(self):
+        for subscription in self.subscriptions:
+            subscription.drain()
+
+    @property
+    def dropped(self):
+        return sum(subscription.dropped for subscription in self.subscriptions)
+
+    async def _read_forever(self):
+        buffer = b""
+        try:
+            while True:
+                chunk = await self.process.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                lines = (buffer + chunk).split(b"\n")
+                buffer = lines.pop()
+                self.lines_read += len(lines)
+                if self.subscriptions:
+                    self._dispatch(lines)
+            logger.error("Logcat process is not running")
+            logger.error("stderr %s", await self.process.stderr.read())
+        finally:
+            for subscription in self.subscriptions:
+                subscription.close()
+
+    def _dispatch(self, lines):
+        for line in lines:
+            line = line.decode('utf-8', errors='ignore').rstrip()
+            tag = line[2:line.find('(')].strip() if line[1:2] == '/' else None
+            for subscription in self.subscriptions:
+                subscription.offer(line, tag)
+
+
 class PokemonGo(object):
-    def __init__(self):
+    def __init__(self, use_persistent_shell=False, timeout=30, max_concurrent_adb=4, touch='input'):
         self.device_id = None
         self.calcy_pid = None
+        self.use_raw_screenshots = True
         self.use_fallback_screenshots = False
+        self.use_persistent_shell = use_persistent_shell
+        self.persistent_shell = None
+        self.timeout = timeout
+        self.max_concurrent_adb = max_concurrent_adb
+        self.adb_semaphore = None
+        self.frame_stream = None
+        self.pipeline = None
+        self.last_input_at = 0
+        self.resolution = None
+        self.logcat = None
+        self.logcat_lines = None
+        self.touch = touch
+        self.minitouch = None
+        self.recorder = None
+
+    async def screencap_raw(self):
+        '''Grabs a raw framebuffer.
+
+        Returns:
+            {tuple} -- As returned by parse_raw_screencap.
+            {None}  -- If raw screenshots are not available on this device.
+        '''
+        if self.pipeline is not None:
+            # Never hand out a frame from before the last tap/swipe.
+            with tracer.span('screencap wait', self.device_id, pipeline=True):
+                captured_at, frame = await self.pipeline.get(self.last_input_at)
+        elif self.frame_stream is not None:
+            with tracer.span('screencap wait', self.device_id):
+                captured_at, frame = await self.frame_stream.wait_for_frame(self.last_input_at)
+        else:
+            captured_at, frame = time.time(), await self.grab_raw_frame()
+        if frame is not None and self.recorder is not None:
+            self.recorder.frame(frame, captured_at)
+        return frame
+
+    async def grab_raw_frame(self, retries=1):
+        '''Like screencap_raw, but always takes a brand new screenshot.
+
+        Only switches to PNG screenshots for good if `screencap` works
+        but its output isn't one we know. When it fails or gets cut
+        short (the phone dropping offline for a moment...), it's just
+        tried again.
+
+        Keyword Arguments:
+            retries {int} -- Tries left after the first one (default: 1).
+
+        Raises:
+            PhoneNotConnectedError -- If it still fails after that.
+        '''
+        if not self.use_raw_screenshots:
+            return None
+        for attempt in range(retries + 1):
+            with tracer.span('screencap transfer', self.device_id):
+                return_code, stdout, stderr = await self.run(["adb", "-s", await self.get_device(), "exec-out", "screencap"])
+            if return_code != 0:
+                error = "screencap exited with {}: {}".format(return_code, stderr.decode('utf-8', errors='ignore').strip())
+            else:
+                try:
+                    with tracer.span('screencap decode', self.device_id):
+                        return parse_raw_screencap(stdout)
+                except TruncatedScreencapError as e:
+                    error = e
+                except ValueError as e:
+                    logger.info("Raw screenshots don't work on this device (%s), switching to PNG ones", e)
+                    self.use_raw_screenshots = False
+                    return None
+            logger.warning("Couldn't take a raw screenshot (%s)%s", error, ", trying again" if attempt < retries else "")
+        raise PhoneNotConnectedError(error)
+
+    async def start_frame_stream(self, depth=3):
+        '''Switches screenshots to a continuous stream of raw frames, or
+        leaves them one at a time if raw screenshots don't work.
+
+        Keyword Arguments:
+            depth {int} -- Number of frames kept in the ring buffer (default: 3).
+        '''
+        # Android 9+ adds the dataspace to the header, so check its size once.
+        return_code, stdout, stderr = await self.run(["adb", "-s", await self.get_device(), "exec-out", "screencap"])
+        if return_code != 0:
+            logger.warning("Couldn't start the frame stream (screencap exited with %s: %s), capturing one at a time instead",
+                           return_code, stderr.decode('utf-8', errors='ignore').strip())
+            return
+        try:
+            width, height, rawmode, pixels = parse_raw_screencap(stdout)
+        except ValueError as e:
+            logger.info("The frame stream needs raw screenshots (%s), capturing one at a time instead", e)
+            return
+        header_size = len(stdout) - width * height * 4
+        cmd = ["adb", "-s", await self.get_device(), "exec-out", "while true; do screencap; done"]
+        self.frame_stream = FrameStream(cmd, header_size, depth, timeout=self.timeout)
+        await self.frame_stream.start()
+
+    async def start_pipeline(self, depth=1, max_age=1.0):
+        '''Captures screenshots in the background, up to depth ahead,
+        so the next one transfers while the current one is analyzed.
+        See CapturePipeline.
+        '''
+        if self.frame_stream is not None:
+            logger.info("The frame stream already captures ahead, not starting a capture pipeline")
+            return
+        if await self.grab_raw_frame() is None:
+            logger.info("The capture pipeline needs raw screenshots, capturing one at a time instead")
+            return
+        self.pipeline = CapturePipeline(self.grab_raw_frame, depth, max_age)
+        await self.pipeline.start()
+
+    async def stop_pipeline(self):
+        if self.pipeline is not None:
+            await self.pipeline.stop()
+            self.pipeline = None
+
+    async def stop_frame_stream(self):
+        if self.frame_stream is not None:
+            await self.frame_stream.stop()
+            self.frame_stream = None
+
+    async def capture_regions(self, boxes):
+        '''Takes a single screenshot and returns only the given regions.
+
+        Arguments:
+            boxes {dict} -- Maps names to [x1, y1, x2, y2] boxes.
+
+        Returns:
+            {dict} -- Maps the same names to the cropped PIL.Images.
+        '''
+        frame = await self.screencap_raw()
+        if frame is not None:
+            with tracer.span('screencap crop', self.device_id, regions=len(boxes)):
+                return {name: crop_raw_screencap(*frame, box) for name, box in boxes.items()}
+        screencap = await self.screencap()
+        if self.recorder is not None:
+            self.recorder.frame(screencap)
+        return {name: screencap.crop(box) for name, box in boxes.items()}
 
     async def screencap(self):
+        frame = await self.screencap_raw()
+        if frame is not None:
+            width, height, rawmode, pixels = frame
+            # Maps the framebuffer directly, without decoding or copying it.
+            return Image.frombuffer('RGBA', (width, height), pixels, 'raw', rawmode, 0, 1)
         if not self.use_fallback_screenshots:
-            return_code, stdout, stderr = await self.run(["adb", "-s", await self.get_device(), "exec-out", "screencap", "-p"])
+            with tracer.span('screencap transfer', self.device_id, png=True):
+                return_code, stdout, stderr = await self.run(["adb", "-s", await self.get_device(), "exec-out", "screencap", "-p"])
             try:
-                return Image.open(BytesIO(stdout))
+                with tracer.span('screencap decode', self.device_id, png=True):
+                    image = Image.open(BytesIO(stdout))
+                    image.load()
+                    return image
             except (OSError, IOError):
                 logger.debug("Screenshot failed, using fallback method")
                 # self.use_fallback_screenshots = True
@@ -52,8 +929,21 @@ class PokemonGo(object):
         image = Image.open("screen.png")
         return image
 
+    async def close(self):
+        '''Stops everything left running in the background.'''
+        await self.stop_pipeline()
+        await self.stop_frame_stream()
+        await self.stop_logcat()
+        if self.minitouch is not None:
+            await self.minitouch.stop()
+            self.minitouch = None
+        if self.persistent_shell is not None:
+            await self.persistent_shell.close()
+            self.persistent_shell = None
+
     async def set_device(self, device_id=None):
         self.device_id = device_id
+        self.resolution = None
 
     async def get_device(self):
         if self.device_id:
@@ -64,13 +954,65 @@ class PokemonGo(object):
         self.device_id = devices[0]
         return self.device_id
 
-    async def run(self, args):
-        logger.debug("Running %s", args)
-        p = subprocess.Popen([str(arg) for arg in args], stdout=subprocess.PIPE)
-        stdout, stderr = p.communicate()
+    async def run(self, args, timeout=None):
+        '''Runs a command without blocking the event loop.
+
+        At most max_concurrent_adb commands run at the same time for
+        this device, the rest wait for a free slot.
+
+        Arguments:
+            args {list} -- The command and its arguments.
+
+        Keyword Arguments:
+            timeout {float} -- Seconds to wait before killing the command
+                               and raising AdbTimeoutError (default: self.timeout).
+
+        Returns:
+            {tuple} -- (return code, stdout, stderr)
+        '''
+        # Created lazily so it belongs to the running loop.
+        if self.adb_semaphore is None:
+            self.adb_semaphore = asyncio.Semaphore(self.max_concurrent_adb)
+        timeout = self.timeout if timeout is None else timeout
+
+        with tracer.span(adb_stage(args), self.device_id, args=args):
+            return await self._run(args, timeout)
+
+    async def _run(self, args, timeout):
+        async with self.adb_semaphore:
+            logger.debug("Running %s", args)
+            p = await asyncio.create_subprocess_exec(
+                *[str(arg) for arg in args],
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(p.communicate(), timeout)
+            except asyncio.TimeoutError:
+                p.kill()
+                await p.wait()
+                logger.error("Command timed out after %ss: %s", timeout, args)
+                raise AdbTimeoutError(args)
         logger.debug("Return code %d", p.returncode)
+        if p.returncode != 0 and stderr:
+            logger.debug("stderr: %s", stderr.decode('utf-8', errors='ignore').strip())
         return (p.returncode, stdout, stderr)
 
+    async def shell(self, *args):
+        '''Runs a command on the device shell, through the persistent
+        session if it is enabled, or a fresh `adb shell` otherwise.
+        '''
+        if not self.use_persistent_shell:
+            return await self.run(["adb", "-s", await self.get_device(), "shell", *args])
+        if self.persistent_shell is None or self.persistent_shell.device_id != await self.get_device():
+            if self.persistent_shell is not None:
+                await self.persistent_shell.close()
+            self.persistent_shell = AdbShell(await self.get_device(), self.timeout)
+        cmd = " ".join(str(arg) for arg in args)
+        logger.debug("Running on persistent shell %s", cmd)
+        with tracer.span('adb shell {}'.format(cmd.split()[0]), self.device_id, args=cmd, persistent=True):
+            return await self.persistent_shell.run(cmd)
+
     async def get_devices(self):
         code, stdout, stderr = await self.run(["adb", "devices"])
         devices = []
@@ -80,50 +1022,61 @@ class PokemonGo(object):
             devices.append(device_id)
         return devices
 
-    async def start_logcat(self):
-        # return_code, stdout, stderr = await self.run(["adb", "-s", await self.get_device(), "shell", "pidof", "-s", "tesmath.calcy"])
-        # logger.debug("Running pidof calcy got code %d: %s", return_code, stdout)
-        # self.calcy_pid = stdout.decode('utf-8').strip()
-        # cmd = ["adb", "-s", await self.get_device(), "logcat", "-T", "1", "-v", "brief", "--pid", self.calcy_pid]
+    async def get_resolution(self):
+        '''Returns the screen resolution as a 'WIDTHxHEIGHT' string.'''
+        if self.resolution is None:
+            return_code, stdout, stderr = await self.shell("wm", "size")
+            sizes = dict((kind, "{}x{}".format(width, height)) for kind, width, height in RE_WM_SIZE.findall(stdout.decode('utf-8', errors='ignore')))
+            if not sizes:
+                raise PhoneNotConnectedError
+            self.resolution = sizes.get('Override', sizes.get('Physical'))
+        return self.resolution
+
+    async def start_logcat(self, tags=None, package=None):
+        '''Starts reading logcat in the background.
+
+        Keyword Arguments:
+            tags {list} -- Only read lines with these tags (filtered on the device).
+            package {str} -- Only read lines from this app's process (filtered on the device).
+        '''
         cmd = ["adb", "-s", await self.get_device(), "logcat", "-T", "1", "-v", "brief"]
-        logger.debug("Starting logcat %s", cmd)
-        self.logcat_task = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        await self.logcat_task.stdout.readline() # Read and discard the one line as -T 0 doesn't work
+        if package:
+            return_code, stdout, stderr = await self.shell("pidof", "-s", package)
+            logger.debug("Running pidof %s got code %d: %s", package, return_code, stdout)
+            self.calcy_pid = stdout.decode('utf-8').strip()
+            if self.calcy_pid:
+                cmd += ["--pid", self.calcy_pid]
+        if tags:
+            cmd += ["{}:V".format(tag) for tag in tags] + ["*:S"]
+        self.logcat = LogcatDispatcher(cmd, timeout=self.timeout)
+        await self.logcat.start()
+
+    async def stop_logcat(self):
+        if self.logcat is not None:
+            await self.logcat.stop()
+            self.logcat = None
 
     async def seek_to_end(self):
-        # Seek to the end of the file
-        while True:
-            try:
-                task = await asyncio.wait_for(self.logcat_task.stdout.readline(), 0.2)
-            except asyncio.TimeoutError:
-                break
+        # Forget everything received so far
+        self.logcat.drain()
 
     async def read_logcat(self):
-        if self.logcat_task.returncode != None:
-            logger.error("Logcat process is not running")
-            logger.error("stdout %s", await self.logcat_task.stdout.read())
-            logger.error("stderr %s", await self.logcat_task.stderr.read())
-            raise LogcatNotRunningError()
-
-        line = await self.logcat_task.stdout.readline()
-        line = line.decode('utf-8', errors='ignore').rstrip()
-        #while line.split()[2].decode('utf-8') != self.calcy_pid:
-        #    line = await self.logcat_task.stdout.readline()
-        #logger.debug("Received logcat line: %s", line)
-        return line
+        if self.logcat_lines is None:
+            self.logcat_lines = self.logcat.subscribe(maxsize=1000)
+        return await self.logcat_lines.get()
 
     async def get_clipboard(self):
-        await self.send_intent("clipper.get")
-        while True:
-            line = await self.read_logcat()
-            match = RE_CLIPBOARD_TEXT.match(line)
-            if match:
-                logger.info("RE_CLIPBOARD_TEXT matched.")
-                return match.group(1)
+        subscription = self.logcat.subscribe(RE_CLIPBOARD_TEXT, maxsize=1)
+        try:
+            await self.send_intent("clipper.get")
+            try:
+                match = await asyncio.wait_for(subscription.get(), self.timeout)
+            except asyncio.TimeoutError:
+                raise AdbTimeoutError("clipper.get")
+            logger.info("RE_CLIPBOARD_TEXT matched.")
+            return match.group(1)
+        finally:
+            self.logcat.unsubscribe(subscription)
 
     async def send_intent(self, intent, package=None, extra_values=[]):
         cmd = "am broadcast -a {}".format(intent)
@@ -137,30 +1090,100 @@ class PokemonGo(object):
             else:
                 cmd = cmd + " -e {} '{}'".format(key, value)
         logger.info("Sending intent: " + cmd)
-        await self.run(["adb", "-s", await self.get_device(), "shell", cmd])
+        await self.shell(cmd)
+        self.last_input_at = time.time()
+
+    async def teleport(self, lat, lng):
+        '''Tells GPS Joystick to jump to lat, lng. Returns right away,
+        see at_location to know when it's done.
+        '''
+        await self.shell('am start-foreground-service -a theappninjas.gpsjoystick.TELEPORT --ef lat {} --ef lng {}'.format(lat, lng))
+        self.last_input_at = time.time()
+
+    async def get_location(self):
+        '''Where the phone thinks it is, from `dumpsys location`.
+
+        Returns:
+            {list} -- [lat, lng], from the gps provider if it has a fix,
+                      otherwise from whichever provider has one.
+            {None} -- If no provider knows where we are.
+        '''
+        return_code, stdout, stderr = await self.shell("dumpsys", "location")
+        locations = parse_dumpsys_location(stdout.decode('utf-8', errors='ignore'))
+        return locations.get('gps') or next(iter(locations.values()), None)
+
+    async def at_location(self, lat, lng, tolerance=25):
+        '''Returns:
+            {bool} -- Whether the phone is within tolerance meters of lat, lng.
+            {None} -- If the phone won't say where it is.
+        '''
+        location = await self.get_location()
+        if location is None:
+            return None
+        return haversine(lat, lng, *location) <= tolerance
+
+    async def get_minitouch(self):
+        '''Returns:
+            {Minitouch} -- Connected to the current device, or None if
+                           minitouch can't be used (then touches fall
+                           back to `input`).
+        '''
+        if self.minitouch is not None and self.minitouch.device_id == await self.get_device():
+            return self.minitouch
+        if self.minitouch is not None:
+            await self.minitouch.stop()
+        self.minitouch = Minitouch(await self.get_device(), await self.get_resolution())
+        try:
+            await self.minitouch.start()
+        except MinitouchNotAvailableError as e:
+            logger.warning("Can't use minitouch (%s), falling back to `input`", e)
+            self.minitouch = None
+            self.touch = 'input'
+        return self.minitouch
+
+    async def gesture(self, steps):
+        '''Plays a list of taps, swipes and waits (see Minitouch) in a
+        single round trip to the phone, returning once they're done.
+
+        If minitouch drops, it is restarted once, and if it drops again
+        (or won't restart) `input` is used from then on.
+        '''
+        played = False
+        for attempt in range(2):
+            minitouch = await self.get_minitouch() if self.touch == 'minitouch' else None
+            if minitouch is None:
+                break
+            try:
+                with tracer.span('minitouch', self.device_id, steps=len(steps)):
+                    await minitouch.gesture(steps)
+                played = True
+                break
+            except ConnectionError as e:
+                await minitouch.stop()
+                self.minitouch = None
+                if attempt:
+                    logger.warning("minitouch dropped again (%s), falling back to `input`", e)
+                    self.touch = 'input'
+                else:
+                    logger.warning("minitouch dropped (%s), restarting it", e)
+        if not played:
+            commands = input_commands(steps)
+            if len(commands) == 1:
+                await self.shell(*commands[0])
+            else:
+                await self.shell(" ; ".join(" ".join(str(arg) for arg in command) for command in commands))
+        self.last_input_at = time.time()
 
     async def tap(self, x, y):
-        await self.run(["adb", "-s", await self.get_device(), "shell", "input", "tap", x, y])
+        await self.gesture([('tap', x, y)])
 
     async def key(self, key):
-        await self.run(["adb", "-s", await self.get_device(), "shell", "input", "keyevent", key])
+        await self.shell("input", "keyevent", key)
+        self.last_input_at = time.time()
 
     async def text(self, text):
-        await self.run(["adb", "-s", await self.get_device(), "shell", "input", "text", text])
+        await self.shell("input", "text", text)
+        self.last_input_at = time.time()
 
     async def swipe(self, x1, y1, x2, y2, duration=None):
-        args = [
-            "adb",
-            "-s",
-            await self.get_device(),
-            "shell",
-            "input",
-            "swipe",
-            x1,
-            y1,
-            x2,
-            y2
-        ]
-        if duration:
-            args.append(duration)
-        await self.run(args)
+        await self.gesture([('swipe', x1, y1, x2, y2, duration)])
@@ -1,19 +1,28 @@
 #!/usr/bin/env python3.7
 import argparse
 import asyncio
+import collections
+import hashlib
 import logging
 import re
 import sys
 import time
 from sys import platform
 
+import numpy as np
 import yaml
 from colorlog import ColoredFormatter
 from PIL import Image
-from pyocr import builders, pyocr
 
-from COOLmeDOWN import calculate, calculateCD, splitCoords
-from pokemonlib import PokemonGo
+from journal import Journal
+from ocr import OcrPool
+from pokemonlib import PhoneNotConnectedError, PokemonGo
+from recorder import FlightRecorder
+from scheduler import CooldownScheduler
+from states import StateClassifier
+from stops import load_stops
+from tracing import tracer
+from vision import ChangeDetector, classify_hues, frame_difference, hue_distance, thumbnail
 
 logger = logging.getLogger('ivcheck')
 logger.setLevel(logging.INFO)
@@ -23,6 +32,12 @@ formatter = ColoredFormatter("  %(log_color)s[%(asctime)s] %(levelname)-8s%(rese
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
+# Mean gray level difference below which two screenshots count as the same.
+SETTLE_THRESHOLD = 2.0
+LATENCY_BUCKETS = [0, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 60]
+# Seconds between `dumpsys location` polls while waiting to arrive.
+LOCATION_INTERVAL = 0.1
+
 def get_median_location(box_location):
     '''
     Given a list of 4 coordinates, returns the central point of diagonal intersections
@@ -30,19 +45,107 @@ def get_median_location(box_location):
     x1, y1, x2, y2 = box_location
     return [int((x1 + x2) / 2), int((y1 + y2) / 2)]
 
+def quest_list_id(quest_list):
+    '''Fingerprint of a quest list, to tell whether a journal belongs to it.'''
+    return hashlib.blake2b(quest_list.coords.tobytes(), digest_size=8).hexdigest()
+
 class Main:
-    def __init__(self, args):
+    def __init__(self, args, device_id=None, ocr=None, clock=None, journal=None):
         with open(args.config, "r") as f:
-            self.config = yaml.load(f)
+            self.config = yaml.safe_load(f)
         self.args = args
-        tools = pyocr.get_available_tools()
-        self.tool = tools[0]
-        self.p = PokemonGo()
+        self.device_id = device_id or args.device_id
+        self.ocr = ocr or OcrPool(args.ocr_workers)
+        self.p = PokemonGo(use_persistent_shell=args.persistent_shell, timeout=args.adb_timeout, touch=args.touch)
+        self.classifier = StateClassifier(args.templates)
+        self.latencies = {}
+        self.scheduler = CooldownScheduler(clock)
+        self.changes = ChangeDetector()
+        self.changed = set()
+        self.region_results = {}
+        self.started_at = None
+        self.spins = 0
+        self.quests = 0
+        journal = journal or args.journal
+        self.journal = Journal(journal) if journal else None
+        self.quest_list_id = None
+        self.stop = 0
+        self.actions_so_far = 0
+        self.confirm_location = True
+        self.settle_samples = collections.deque(maxlen=20)
+        self.ready_times = {}
+        self.recorder = FlightRecorder(int(args.recorder_mb * (1 << 20))) if args.recorder_mb > 0 else None
+        self.p.recorder = self.recorder
+
+    def checkpoint(self, event, done=False):
+        '''Journals that event just happened at the current stop.
+
+        Arguments:
+            event {str} -- What happened: teleport, spin, done, claim or finished.
+
+        Keyword Arguments:
+            done {bool} -- Whether we're done with the current stop.
+        '''
+        if self.journal is None:
+            return
+        model = self.scheduler.model
+        self.journal.append(event, quest_list=self.quest_list_id, stop=self.stop, done=done,
+                            actions_so_far=self.actions_so_far,
+                            last_spin=None if model.last_spin_at is None else [model.last_lat, model.last_lng, model.last_spin_at])
+
+    def resume(self, quest_list):
+        '''Picks up the state left by the last run of quest_list, if
+        it didn't finish.
 
-    async def hue_affinity(self, im, hue1, hue2):
-        '''Checks the affinity, in percentual terms,
-        of the average median im hue against hue1 and
-        hue2.
+        The last spin is restored either way, so the cooldown is never
+        broken across restarts.
+
+        Returns:
+            {int} -- Number of the stop to start at.
+        '''
+        self.quest_list_id = quest_list_id(quest_list)
+        state = self.journal.load() if self.journal else None
+        if state is None:
+            return 1
+        if state['last_spin']:
+            lat, lng, at = state['last_spin']
+            self.scheduler.record_spin([lat, lng], at)
+        if state['quest_list'] != self.quest_list_id or state['event'] == 'finished':
+            return 1
+        self.actions_so_far = state['actions_so_far']
+        if state['event'] == 'spin':
+            # Stopped right after swiping: it most likely worked, and going
+            # back to check would only find the stop already spun.
+            self.actions_so_far += 1
+            return state['stop'] + 1
+        return state['stop'] + 1 if state['done'] else state['stop']
+
+    def record(self, kind, **data):
+        '''Notes down something that happened for the flight recorder.'''
+        if self.recorder is not None:
+            self.recorder.event(kind, **data)
+
+    def dump_flight(self, reason):
+        '''Writes out the flight recorder, to see what led to reason.'''
+        if self.recorder is None:
+            return
+        try:
+            self.recorder.dump(self.args.recorder_dir, self.p.device_id or 'device', reason)
+        except OSError as e:
+            logger.error('Could not dump the flight recorder: %s', e)
+
+    def throughput(self):
+        '''Returns:
+            {tuple} -- Pokestops spun and quests claimed per hour so far.
+        '''
+        hours = (time.time() - self.started_at) / 3600 if self.started_at else 0
+        if hours <= 0:
+            return 0, 0
+        return self.spins / hours, self.quests / hours
+
+    async def hue_affinity(self, im, hue1, hue2, location=None):
+        '''Checks whether the average hue of im is
+        closer to hue1 or to hue2.
 
         Input values are in range 0-255, instead of
         the common 0-360° used for HSL and HSV images.
@@ -52,87 +155,304 @@ class Main:
             hue1  {int}     -- 0-255
             hue2  {int}     -- 0-255
 
+        Keyword Arguments:
+            location {str}  -- Config location im was cropped
+                               from, to reuse the last result
+                               while it doesn't change.
+
         Returns:
-            {tuple}   -- A tuple containing the relative
-                         percentages lenghts of the arcs
-                         between im's median hue against
-                         hue1 and hue2, respectively.
+            {bool}    -- True if closer to hue1, False if
+                         closer to hue2.
+            {None}    -- If it's right in the middle or
+                         there's no color at all to tell.
+        '''
+        if location is None:
+            with tracer.span('hue', self.p.device_id):
+                result, hue, confidence = classify_hues([im], hue1, hue2)[0]
+        else:
+            result, hue, confidence = self.classify_hue(location, im, hue1, hue2)
+        logger.info('Detected H: %i (H1: %s | H2: %s) with a confidence of %i%%', hue, hue1, hue2, confidence * 100)
+        return result
+
+    async def wait_until(self, transition, detector, timeout, interval=0.1, frames=True):
+        '''Polls detector until it returns something truthy,
+        or until timeout seconds have passed.
+
+        How long it took is recorded under transition,
+        see log_latencies.
+
+        Arguments:
+            transition {str}       -- Name to record the latency under.
+            detector   {callable}  -- Coroutine function without arguments.
+            timeout    {float}     -- Seconds to give up after.
+
+        Keyword Arguments:
+            interval {float} -- Seconds between polls (default: 0.1).
+            frames   {bool}  -- Whether detector looks at screenshots, which
+                                with the pipeline already wait for the next
+                                frame, so there's no need to sleep (default: True).
+
+        Returns:
+            The last result of detector.
+        '''
+        started = time.time()
+        with tracer.span('wait ' + transition, self.p.device_id):
+            while True:
+                result = await detector()
+                elapsed = time.time() - started
+                if result or elapsed >= timeout:
+                    break
+                if self.p.pipeline is None or not frames:
+                    await asyncio.sleep(interval)
+        self.latencies.setdefault(transition, []).append((elapsed, timeout, bool(result)))
+        return result
+
+    def log_latencies(self):
+        '''Logs a histogram of how long each transition took so far, and
+        how much time waiting for it saved over the fixed waits.
+        '''
+        for transition, samples in sorted(self.latencies.items()):
+            elapsed = np.array([sample[0] for sample in samples])
+            counts, edges = np.histogram(elapsed, bins=LATENCY_BUCKETS)
+            histogram = ' '.join('<{:g}s:{}'.format(edge, count) for edge, count in zip(edges[1:], counts) if count)
+            timeouts = sum(1 for sample in samples if not sample[2])
+            saved = sum(max(0, sample[1] - sample[0]) for sample in samples)
+            logger.info('[Latency] %s: n=%d p50=%.2fs p90=%.2fs max=%.2fs timeouts=%d saved=%.0fs | %s',
+                        transition, len(samples), np.percentile(elapsed, 50), np.percentile(elapsed, 90),
+                        elapsed.max(), timeouts, saved, histogram)
+
+    def settle_time(self):
+        '''How long to leave the map loading after arriving before even
+        looking at it: a bit less than the quickest it has been ready
+        lately, so screenshots aren't spent on a map that can't be
+        ready yet. Nothing until a few stops have gone by.
+        '''
+        if len(self.settle_samples) < 3:
+            return 0
+        return 0.8 * float(np.percentile(self.settle_samples, 10))
+
+    async def teleport(self, coords):
+        '''Teleports to coords and waits until the map is ready there.
+
+        Arrival is confirmed from the location the phone reports, which
+        is much cheaper than screenshots and OCR, and as soon as it
+        matches we wait out settle_time and then for the screen to stop
+        changing. Phones that won't say where they are just wait for
+        the screen to change and settle.
+
+        Returns:
+            {float} -- Seconds from the teleport to the map being ready.
+        '''
+        timeout = self.config['waits'].get('teleport', 10)
+        started = time.time()
+        arrived_at = None
+        if self.args.fixed_waits:
+            await self.p.teleport(*coords)
+            logger.debug('Waiting %s seconds after teleport...', timeout)
+            await asyncio.sleep(timeout)
+        else:
+            until = None if self.confirm_location else await self.screen_settled()
+            await self.p.teleport(*coords)
+            if self.confirm_location:
+                located = False
+
+                async def arrived():
+                    nonlocal located
+                    result = await self.p.at_location(*coords, tolerance=self.args.location_tolerance)
+                    located = located or result is not None
+                    return result
+
+                if await self.wait_until('arrival', arrived, timeout, LOCATION_INTERVAL, frames=False):
+                    arrived_at = time.time()
+                    await asyncio.sleep(self.settle_time())
+                elif not located:
+                    logger.warning("The phone won't tell its location, waiting for the screen from now on")
+                    self.confirm_location = False
+                else:
+                    logger.error("Still not at %s after %ss, moving on anyway", coords, timeout)
+                until = await self.screen_settled(changed=True)
+            await self.wait_until('loading', until, max(0, timeout - (time.time() - started)))
+
+        idle = 0.1
+        while await self.check_where_the_hell_are_we() != 'on_world':
+            # TODO: put something that checks that the pokestop is actually on top of the character
+            logger.info("We still seem to be loading")
+            if self.changed:
+                idle = 0.1
+            else:
+                # Nothing moved, no point in checking again right away.
+                await asyncio.sleep(idle)
+                idle = min(idle * 2, 2)
+
+        ready_at = time.time()
+        if arrived_at is not None:
+            self.settle_samples.append(ready_at - arrived_at)
+            logger.info('Ready %.2fs after teleporting (arrived after %.2fs)', ready_at - started, arrived_at - started)
+        else:
+            logger.info('Ready %.2fs after teleporting', ready_at - started)
+        return ready_at - started
+
+    async def screen_signature(self):
+        return thumbnail(await self.p.screencap())
+
+    async def screen_settled(self, changed=False):
+        '''Returns a detector that becomes true once the screen has
+        changed from how it is right now and then stopped changing.
+
+        Keyword Arguments:
+            changed {bool} -- Whether we already know it changed, so it
+                              only has to stop changing (default: False).
+        '''
+        before = last = await self.screen_signature()
+
+        async def detector():
+            nonlocal last, changed
+            current = await self.screen_signature()
+            changed = changed or frame_difference(before, current) > SETTLE_THRESHOLD
+            settled = changed and frame_difference(last, current) <= SETTLE_THRESHOLD
+            last = current
+            return settled
+        return detector
+
+    async def pokestop_bar_color(self, tolerance=25):
+        '''Like hue_affinity for the bottom pokestop bar, but quiet, and
+        None unless the hue is really close to blue or purple, so
+        whatever the map shows there before the pokestop opens won't do.
+        '''
+        crop = (await self.capture('bottom_pokestop_bar'))['bottom_pokestop_bar']
+        is_color_blue, hue, confidence = self.classify_hue('bottom_pokestop_bar', crop, 130, 200)
+        if is_color_blue is None or hue_distance(hue, 130 if is_color_blue else 200) > tolerance:
+            return None
+        return is_color_blue
+
+    async def pokestop_opened(self):
+        return await self.pokestop_bar_color() is not None
+
+    async def pokestop_spun(self):
+        return await self.pokestop_bar_color() is False
+
+    async def wait_after(self, location, action, until=None):
+        '''Runs action, then waits for the screen to react to it.
+
+        The wait configured for location is only the timeout: we
+        move on as soon as until (or, if not given, the screen
+        settling down) says so.
         '''
-        ## Image filtering mumbojumbo
-        im = im.quantize()
-        im = im.resize((1, 1))
-        im = im.convert('HSV')
-        pixel = im.getpixel((0, 0))
-
-        ## Gets us one only int, the average hue of the image
-        hue = pixel[0]
-
-        ## The Angles
-        # The modulus makes it a polar function, i.e.:
-        # everything that overflows or underflows 255
-        # becomes the difference, so we don't need to
-        # translate values nor calculate distances :)
-        a1 = abs(hue-hue1) % 255
-        a2 = abs(hue-hue2) % 255
-
-        # This is just for giggles
-        confidence = (1 - (min(a1, a2) / max(a1, a2))) * 100
-
-        logger.info('Detected H: %s (%i%% of H1: %s | %i%% of H2: %s) with a confidence of %i%%', hue, a1, hue1, a2, hue2, confidence)
-
-        if a1 < a2:
-            return True
-            # return ((((a1 + hue) / hue) - 1) * 100, (((a2 + hue) / hue) - 1) * 100)
-        if a2 < a1:
-            return False
-            # return ((((a1 + hue) / hue) - 1) * 100, (((a2 + hue) / hue) - 1) * 100)
-        raise Exception("Well you got unlucky boy, it's right on the middle")
-
-    async def tap(self, location):
+        if location not in self.config['waits']:
+            await action
+            return
+        timeout = self.config['waits'][location]
+        if self.args.fixed_waits:
+            await action
+            logger.debug('Waiting %s seconds after %s...', timeout, location)
+            await asyncio.sleep(timeout)
+            return
+        if until is None:
+            until = await self.screen_settled()
+        await action
+        await self.wait_until(location, until, timeout)
+
+    async def tap(self, location, until=None):
+        self.record('tap', location=location)
         coordinates = self.config['locations'][location]
         if len(coordinates) == 2:
-            await self.p.tap(*coordinates)
-            if location in self.config['waits']:
-                await asyncio.sleep(self.config['waits'][location])
+            await self.wait_after(location, self.p.tap(*coordinates), until)
         elif len(coordinates) == 4:
             median_location = get_median_location(coordinates)
-            await self.p.tap(*median_location)
-            if location in self.config['waits']:
-                await asyncio.sleep(self.config['waits'][location])
+            await self.wait_after(location, self.p.tap(*median_location), until)
         else:
             logger.error('Something is not right.')
             raise Exception
 
-    async def swipe(self, location, duration):
-        await self.p.swipe(
+    async def swipe(self, location, duration, until=None):
+        self.record('swipe', location=location, duration=duration)
+        await self.wait_after(location, self.p.swipe(
             self.config['locations'][location][0],
             self.config['locations'][location][1],
             self.config['locations'][location][2],
             self.config['locations'][location][3],
             duration
-        )
-        if location in self.config['waits']:
-            logger.info('Waiting %s seconds after %s...', self.config['waits'][location], self.config['locations'][location])
-            await asyncio.sleep(self.config['waits'][location])
+        ), until)
 
     async def key(self, keycode):
+        self.record('key', keycode=keycode)
         await self.p.key(keycode)
         if str(keycode).lower in self.config['waits']:
             await asyncio.sleep(self.config['waits'][str(keycode).lower])
 
-    async def check_where_the_hell_are_we(self):
-        screencap = await self.p.screencap()
+    async def capture(self, *locations):
+        '''Takes one screenshot and crops the given config locations out of it.
 
-        text_gps = screencap.crop(self.config['locations']['im_a_passenger_button_box'])
-        text_gps = self.tool.image_to_string(text_gps).replace("\n", " ")
-        if 'PASSENGER' in text_gps:
+        Whatever was figured out about the locations that changed
+        since they were last captured is forgotten, and their names
+        are left in self.changed.
+
+        Returns:
+            {dict} -- Maps each location to its cropped PIL.Image.
+        '''
+        crops = await self.p.capture_regions({location: self.config['locations'][location] for location in locations})
+        self.changed = self.changes.update(crops)
+        if self.changed:
+            self.region_results = {key: result for key, result in self.region_results.items() if key[0] not in self.changed}
+        return crops
+
+    def classify_hue(self, location, crop, hue1, hue2):
+        '''classify_hues for a single captured location, reusing the
+        last result while the location doesn't change.
+        '''
+        key = (location, 'hue', hue1, hue2)
+        if key not in self.region_results:
+            with tracer.span('hue', self.p.device_id, location=location):
+                self.region_results[key] = classify_hues([crop], hue1, hue2)[0]
+        result, hue, confidence = self.region_results[key]
+        self.record('hue', location=location, hue=hue, result=result, confidence=confidence)
+        return self.region_results[key]
+
+    async def find_showing(self, crops, words):
+        '''Checks which crops show any of their words.
+
+        Asks the template classifier first and only OCRs, all
+        in parallel, the crops it has no templates for or
+        isn't sure about.
+
+        Arguments:
+            crops {dict} -- Maps locations to their crops.
+            words {dict} -- Maps the same locations to the words to look for.
+
+        Returns:
+            {dict} -- Maps each location to a bool.
+        '''
+        found = {}
+        for location, crop in crops.items():
+            found[location] = self.region_results.get((location, 'showing'))
+            if found[location] is None:
+                found[location] = self.classifier.detect(location, crop)
+        unsure = [location for location, result in found.items() if result is None]
+        texts = await self.ocr.images_to_strings([crops[location] for location in unsure])
+        for location, text in zip(unsure, texts):
+            self.record('ocr', location=location, text=text)
+            found[location] = any(word in text for word in words[location])
+            if found[location] and self.args.record_templates:
+                self.classifier.record(location, crops[location])
+        for location, result in found.items():
+            self.region_results[(location, 'showing')] = result
+        self.record('showing', found=found)
+        return found
+
+    async def check_where_the_hell_are_we(self):
+        crops = await self.capture('im_a_passenger_button_box', 'oh_hatching_box', 'shop_button_text_box')
+        found = await self.find_showing(crops, {
+            'im_a_passenger_button_box': ['PASSENGER'],
+            'oh_hatching_box': ['Oh', '?'],
+            'shop_button_text_box': ['SHOP'],
+        })
+
+        if found['im_a_passenger_button_box']:
             logger.error("I'M NOT A PASSENGER, I'M A SPOOFER, WHEN ARE YOU GOING TO UNDERSTAND?!")
             await self.tap('im_a_passenger_button_box')
             return 'on_passenger'
 
-        text_oh = screencap.crop(self.config['locations']['oh_hatching_box'])
-        text_oh = self.tool.image_to_string(text_oh).replace("\n", " ")
-        if 'Oh' in text_oh or '?' in text_oh:
+        if found['oh_hatching_box']:
             logger.error('Oh, look at that, we just hatched an egg, lol.')
             # click anywhere, twice (we click on i'm a passenger button)
             await self.tap('im_a_passenger_button_box')
@@ -143,9 +463,7 @@ class Main:
             await self.tap('x_button')
             return 'on_egg'
 
-        text_shop = screencap.crop(self.config['locations']['shop_button_text_box'])
-        text_shop = self.tool.image_to_string(text_shop).replace("\n", " ")
-        if 'SHOP' in text_shop:
+        if found['shop_button_text_box']:
             logger.error('Looks like somehow we went onto the menu... lolz')
             await self.tap('x_button')
             return 'on_menu'
@@ -153,38 +471,33 @@ class Main:
         return 'on_world'
 
     async def cap_and_crop(self, location):
-        screencap = await self.p.screencap()
-        crop = screencap.crop(self.config['locations'][location])
-        text = self.tool.image_to_string(crop).replace("\n", " ")
+        crop = (await self.capture(location))[location]
+        if (location, 'text') not in self.region_results:
+            self.region_results[(location, 'text')] = await self.ocr.image_to_string(crop)
+        text = self.region_results[(location, 'text')]
+        self.record('ocr', location=location, text=text)
         logger.info('[OCR] Found text: %s', text)
         return text
 
-    async def spin_pokestop(self, time_when_cooldown_ends):
-        '''Spins pokestop
+    async def spin_pokestop(self, coords):
+        '''Spins pokestop at coords, as soon as the cooldown allows it.
 
         Returns:
             {bool} -- True means you can move on to next pokestop, false means not.
         '''
 
         logger.info('Clicking PokeStop')
-        await self.tap('pokestop')
+        await self.tap('pokestop', until=self.pokestop_opened)
 
         while True:
-            screencap = await self.p.screencap()
-            crop = screencap.crop(self.config['locations']['bottom_pokestop_bar'])
-            is_color_blue = await self.hue_affinity(crop, 130, 200)
+            crop = (await self.capture('bottom_pokestop_bar'))['bottom_pokestop_bar']
+            is_color_blue = await self.hue_affinity(crop, 130, 200, 'bottom_pokestop_bar')
             if is_color_blue:
                 logger.info("We're certainly on a non spun pokestop yet! :D We shall wait for the cooldown.")
-                while time.time() < time_when_cooldown_ends:
-                    # sys.stdout.write("\r")
-                    # sys.stdout.write("{:2f} seconds remaining.".format(time_when_cooldown_ends - time.time()))
-                    # sys.stdout.flush()
-                    half_life = (time_when_cooldown_ends - time.time()) / 2
-                    logger.info('%f seconds to go...', half_life)
-                    half_life = half_life if half_life >= 2 else 2
-                    await asyncio.sleep(half_life)
+                with tracer.span('cooldown wait', self.p.device_id):
+                    await self.scheduler.wait_until_legal(coords)
                 logger.warning("Cooldown is OVER! Let's go.")
-            elif not is_color_blue:
+            elif is_color_blue is False:
                 logger.info("We already spun this pokestop! I'm leaving and moving on!")
                 await self.tap('x_button')
                 return 'skip'
@@ -193,11 +506,13 @@ class Main:
                 return 'repeat'
 
             logger.info('Spinning...')
-            await self.swipe('spin_swipe', 300)
-            screencap = await self.p.screencap()
-            crop = screencap.crop(self.config['locations']['bottom_pokestop_bar'])
-            is_color_blue = await self.hue_affinity(crop, 130, 200)
-            if not is_color_blue:
+            # Even if it doesn't look like it worked, it might have, so the cooldown starts anyway.
+            self.scheduler.record_spin(coords)
+            self.checkpoint('spin')
+            await self.swipe('spin_swipe', 300, until=self.pokestop_spun)
+            crop = (await self.capture('bottom_pokestop_bar'))['bottom_pokestop_bar']
+            is_color_blue = await self.hue_affinity(crop, 130, 200, 'bottom_pokestop_bar')
+            if is_color_blue is False:
                 logger.info('All good! Leaving PokeStop')
                 await self.tap('x_button')
                 return 'ok'
@@ -228,40 +543,74 @@ class Main:
 
 
 
-    async def start(self):
-        await self.p.set_device(self.args.device_id)
-
-        with open('quest_list.txt', 'r') as file:
-            quest_list = file.read().splitlines()
-
-        actions_so_far = 0
-        time_start = time_when_cooldown_ends = 0
-        for num, quest in enumerate(quest_list, start=1):
-            time_start = time.time()
-
-            quest_coords = splitCoords(quest)
-            logger.warning('Teleporting to quest number %s, coords: %s', num, quest_coords)
-            await self.p.run(["adb", "-s", await self.p.get_device(), "shell", 'am start-foreground-service -a theappninjas.gpsjoystick.TELEPORT --ef lat {} --ef lng {}'.format(*quest_coords)])
-            await asyncio.sleep(10)
-
-            while await self.check_where_the_hell_are_we() is not 'on_world':
-                # TODO: put something that checks that the pokestop is actually on top of the character
-                logger.info("We still seem to be loading")
+    async def start(self, quest_list=None):
+        await self.p.set_device(self.device_id)
+        self.classifier.load(await self.p.get_resolution())
+
+        if quest_list is None:
+            quest_list = load_stops(self.args.quest_list)
+        first = self.resume(quest_list)
+        if self.args.fresh:
+            first, self.actions_so_far = 1, 0
+        elif first > 1:
+            logger.warning('Resuming the last run at stop number %s of %s (%s of %s actions done for the quest)',
+                           first, len(quest_list), self.actions_so_far, self.args.num)
+
+        try:
+            if self.args.stream_frames:
+                await self.p.start_frame_stream(self.args.stream_frames)
+            elif self.args.pipeline_depth:
+                await self.p.start_pipeline(self.args.pipeline_depth)
+            await self.visit(quest_list, first)
+        except Exception as e:
+            self.dump_flight('{!r} at stop {}'.format(e, self.stop))
+            raise
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+            if self.recorder is not None:
+                self.recorder.close()
+            await self.p.close()
+
+    async def visit(self, quest_list, first=1):
+        '''Goes through quest_list, from stop number first on.'''
+        self.started_at = time.time()
+        for num, quest_coords in enumerate(quest_list, start=1):
+            if num < first:
                 continue
-
+            self.stop = num
+            # The cooldown runs down while we teleport, load the map and check for prompts.
+            logger.warning('Teleporting to quest number %s, coords: %s (cooldown ends in %.0fs)',
+                           num, quest_coords, self.scheduler.seconds_until_legal(quest_coords))
+            self.record('teleport', stop=num, coords=quest_coords)
+            with tracer.span('teleport', self.p.device_id, stop=num):
+                self.ready_times[num] = await self.teleport(quest_coords)
+            self.record('ready', stop=num, seconds=self.ready_times[num])
+            self.latencies.setdefault('ready', []).append((self.ready_times[num], self.config['waits'].get('teleport', 10), True))
+            self.checkpoint('teleport')
+
+            repeats = 0
             while True:
                 # TODO: needs to be separated into: open_pokestop and functions for each action.
-                result = await self.spin_pokestop(time_when_cooldown_ends)
+                result = await self.spin_pokestop(quest_coords)
+                self.record('spin_pokestop', stop=num, result=result)
                 if result == 'repeat':
+                    repeats += 1
+                    if repeats == self.args.dump_after_repeats:
+                        logger.error('Tried stop number %s %s times already, dumping the flight recorder', num, repeats)
+                        self.dump_flight('{} repeats at stop {}'.format(repeats, num))
                     await asyncio.sleep(5)
                     await self.swipe('spin_swipe', 800)
                     continue
                 elif result == 'skip':
-                    actions_so_far -= 1
+                    self.actions_so_far -= 1
+                    self.checkpoint('done', done=True)
                     break
                 elif result == 'ok':
-                    actions_so_far += 1
-                    if actions_so_far >= args.num:
+                    self.spins += 1
+                    self.actions_so_far += 1
+                    self.checkpoint('done', done=True)
+                    if self.actions_so_far >= self.args.num:
                         # Finished, can claim quest
                         await self.tap('quest_button')
 
@@ -273,31 +622,134 @@ class Main:
                         logger.warning("Cool, we got another one! :D ")
                         await self.tap('claim_reward_box')
                         await self.tap('exit_encounter')
-                        actions_so_far = 0
+                        self.quests += 1
+                        self.actions_so_far = 0
+                        self.checkpoint('claim', done=True)
+                    break
 
-                    next_quest = quest_list[num + 1]
-                    next_quest_coords = splitCoords(next_quest)
-                    cooldown_until_next_stop = calculateCD(calculate(*quest_coords, *next_quest_coords)) * 60  # in seconds
+            quest_list.visited[num - 1] = True
+            self.log_latencies()
+            if self.args.metrics:
+                tracer.write_prometheus(self.args.metrics)
+        self.checkpoint('finished', done=True)
 
-                    time_taken = time.time() - time_start
-                    total_time_to_wait = time.time() + max(5, cooldown_until_next_stop - time_taken) * 1.10  # adds extra 10% and fixed 5 sec.
-                    time_when_cooldown_ends = time.time() + total_time_to_wait
-                    break
 
+class Rack:
+    '''Drives every connected phone at once from a single process.
 
+    Each phone gets its own Main (so its own PokemonGo) and a
+    contiguous slice of the quest list. They all share the event loop
+    and the OCR worker pool.
+    '''
+    def __init__(self, args, ocr=None, clock=None):
+        self.args = args
+        self.ocr = ocr or OcrPool(args.ocr_workers)
+        self.clock = clock
+        self.mains = {}
 
+    async def start(self):
+        devices = await PokemonGo().get_devices()
+        if not devices:
+            raise PhoneNotConnectedError
+        quest_list = load_stops(self.args.quest_list)
+        size = -(-len(quest_list) // len(devices))
+        logger.warning('Found %d devices, %d stops each', len(devices), size)
+
+        for device in devices:
+            journal = '{}.{}'.format(self.args.journal, device) if self.args.journal else None
+            self.mains[device] = Main(self.args, device, self.ocr, self.clock, journal)
+        reporter = asyncio.ensure_future(self.report_forever())
+        results = await asyncio.gather(*[
+            main.start(quest_list[i * size:(i + 1) * size]) for i, main in enumerate(self.mains.values())
+        ], return_exceptions=True)
+        reporter.cancel()
+
+        for device, result in zip(self.mains, results):
+            if isinstance(result, Exception):
+                logger.error('[%s] Stopped with %r', device, result)
+        self.report()
+
+    def report(self):
+        total_spins = total_quests = 0
+        for device, main in self.mains.items():
+            spins, quests = main.throughput()
+            total_spins += spins
+            total_quests += quests
+            ready = np.median(list(main.ready_times.values())) if main.ready_times else 0
+            logger.info('[%s] %d stops, %d quests (%.1f stops/h, %.1f quests/h, ready %.1fs after teleporting)',
+                        device, main.spins, main.quests, spins, quests, ready)
+        logger.warning('Total: %.1f stops/h, %.1f quests/h', total_spins, total_quests)
+
+    async def report_forever(self):
+        while True:
+            await asyncio.sleep(self.args.report_every)
+            self.report()
 
-if __name__ == '__main__':
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Pokemon go renamer')
     parser.add_argument('--device-id', type=str, default=None,
                         help="Optional, if not specified the phone is automatically detected. Useful only if you have multiple phones connected. Use adb devices to get a list of ids.")
     parser.add_argument('--config', type=str, default='config.yaml',
                         help="Config file location.")
+    parser.add_argument('--all-devices', action='store_true',
+                        help="Drives every connected phone at once, splitting the quest list between them.")
+    parser.add_argument('--report-every', type=float, default=300,
+                        help="Seconds between throughput reports when using --all-devices.")
+    parser.add_argument('--quest-list', type=str, default='quest_list.txt',
+                        help="File with the pokestops to visit: lat,lng or Google Maps links one per line, a CSV or a GPX (see stops.py).")
     parser.add_argument('--action', type=str, default='spin',
                         help="Action to perform required by the particular quest type. Available options: Spin N PokeStops"),  #Trade X
     parser.add_argument('-n', '--num', type=int, default='1',
                         help="Number of times that the action must be performed to complete the quest (i.e.: the N on the options below)."
                         + "After the action is performed N times, the completed quest will be claimed, and the process starts again."),
-    args = parser.parse_args()
+    parser.add_argument('--persistent-shell', action='store_true',
+                        help="Keeps a single adb shell session open per device instead of spawning a new adb process for every tap/swipe.")
+    parser.add_argument('--adb-timeout', type=float, default=30,
+                        help="Seconds to wait for each adb command before giving up.")
+    parser.add_argument('--touch', type=str, default='input', choices=['input', 'minitouch'],
+                        help="How to tap and swipe: the `input` command, or minitouch (much faster, needs its binary at /data/local/tmp/minitouch; falls back to `input` if it doesn't start).")
+    parser.add_argument('--stream-frames', type=int, default=0, metavar='DEPTH',
+                        help="Keeps a continuous screenshot stream open and reads the newest frame from a ring buffer of DEPTH frames, instead of taking a new screenshot every time.")
+    parser.add_argument('--pipeline-depth', type=int, default=0, metavar='DEPTH',
+                        help="Takes up to DEPTH screenshots ahead in the background, so the next one transfers while the last one is analyzed (0: one at a time).")
+    parser.add_argument('--location-tolerance', type=float, default=25, metavar='METERS',
+                        help="How close the location the phone reports must be to a stop to count as having arrived there after teleporting.")
+    parser.add_argument('--templates', type=str, default='templates',
+                        help="Directory with the reference crops used to recognize the screen without OCR (see states.py).")
+    parser.add_argument('--record-templates', action='store_true',
+                        help="Saves every crop that OCR recognizes as a new template.")
+    parser.add_argument('--fixed-waits', action='store_true',
+                        help="Always sleeps the full waits from the config after each action, instead of moving on as soon as the screen is ready.")
+    parser.add_argument('--ocr-workers', type=int, default=2,
+                        help="Number of OCR worker processes.")
+    parser.add_argument('--journal', type=str, default='questr.journal', metavar='FILE',
+                        help="Where to keep track of the run, so that a restart resumes at the same stop with the right cooldown (with --all-devices, one FILE.<device id> per phone). Empty to disable.")
+    parser.add_argument('--fresh', action='store_true',
+                        help="Starts the quest list over from the first stop instead of resuming the last run (the last spin's cooldown still counts).")
+    parser.add_argument('--recorder-mb', type=float, default=16, metavar='MB',
+                        help="Keeps the last MB worth of shrunk screenshots per device in memory, along with every tap, OCR and hue behind them, to write out if the bot gets stuck (0 to disable).")
+    parser.add_argument('--recorder-dir', type=str, default='flights', metavar='DIR',
+                        help="Where the flight recorder is written out to.")
+    parser.add_argument('--dump-after-repeats', type=int, default=5, metavar='N',
+                        help="Writes out the flight recorder once a stop has had to be retried N times in a row.")
+    parser.add_argument('--trace', type=str, default=None, metavar='FILE',
+                        help="Times every adb command, screenshot, OCR, teleport and cooldown wait, and writes them to FILE as a Chrome trace on exit (open it in chrome://tracing).")
+    parser.add_argument('--metrics', type=str, default=None, metavar='FILE',
+                        help="Writes per-stage latency histograms to FILE in the Prometheus text format after every stop.")
+    return parser.parse_args(argv)
 
-    asyncio.run(Main(args).start())
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.trace or args.metrics:
+        tracer.enable(events=bool(args.trace))
+    main = Rack(args) if args.all_devices else Main(args)
+    try:
+        asyncio.run(main.start())
+    finally:
+        main.ocr.close()
+        if args.trace:
+            tracer.write_chrome_trace(args.trace)
+        if args.metrics:
+            tracer.write_prometheus(args.metrics)
@@ -0,0 +1,130 @@
+'''A flight recorder: what the bot saw and did lately, kept in memory
+and only written out when something goes wrong.
+
+Every screenshot is handed to a worker thread that shrinks it and
+compresses it to a JPEG, and every tap, OCR result, hue and decision
+is kept as a small event. Both live in rings capped in size, so the
+oldest go first and memory never grows past what was asked for:
+
+    recorder = FlightRecorder(max_bytes=16 << 20)
+    recorder.frame(raw_frame)
+    recorder.event('tap', location='pokestop')
+    ...
+    recorder.dump('flights', 'fake0', 'stuck repeating')
+
+Recording only hands a reference over to the worker (frames) or
+appends a tuple (events), so it costs next to nothing on the hot
+path. If the worker falls behind, frames are dropped rather than
+queued up, so on top of max_bytes only up to max_pending full size
+frames are ever held.
+'''
+import collections
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+logger = logging.getLogger('recorder')
+
+
+class FlightRecorder(object):
+    '''Rings of the last frames and events of one device.
+
+    Keyword Arguments:
+        max_bytes {int} -- Cap on the compressed frames kept (default: 16MB).
+        max_events {int} -- Number of events kept (default: 2000).
+        reduce {int} -- Frames are shrunk by this factor on each side (default: 4).
+        quality {int} -- JPEG quality of the frames (default: 60).
+        max_pending {int} -- Frames waiting for the worker past which new
+                             ones are dropped (default: 2).
+    '''
+    def __init__(self, max_bytes=16 << 20, max_events=2000, reduce=4, quality=60, max_pending=2):
+        self.max_bytes = max_bytes
+        self.reduce = reduce
+        self.quality = quality
+        self.max_pending = max_pending
+        self.frames = collections.deque()
+        self.frame_bytes = 0
+        self.events = collections.deque(maxlen=max_events)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = []
+        self.last_frame_at = None
+        self.frames_seen = 0
+        self.dropped = 0
+
+    def frame(self, frame, at=None):
+        '''Records a screenshot, either a raw frame (see
+        pokemonlib.parse_raw_screencap) or a PIL.Image, taken at the
+        given time (default: now).
+        '''
+        at = time.time() if at is None else at
+        if at == self.last_frame_at:
+            # The same frame handed out again by the stream or pipeline.
+            return
+        self.last_frame_at = at
+        self.frames_seen += 1
+        self.pending = [future for future in self.pending if not future.done()]
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(1)
+        self.pending.append(self.executor.submit(self._compress, frame, self.frames_seen, at))
+
+    def event(self, kind, **data):
+        '''Records something the bot did or found out.'''
+        self.events.append((time.time(), self.frames_seen, kind, data))
+
+    def _compress(self, frame, number, at):
+        if isinstance(frame, tuple):
+            width, height, rawmode, pixels = frame
+            frame = Image.frombuffer('RGBA', (width, height), pixels, 'raw', rawmode, 0, 1)
+        im = frame.reduce(self.reduce) if self.reduce > 1 else frame
+        buffer = io.BytesIO()
+        im.convert('RGB').save(buffer, 'JPEG', quality=self.quality)
+        data = buffer.getvalue()
+        with self.lock:
+            self.frames.append((number, at, data))
+            self.frame_bytes += len(data)
+            while self.frame_bytes > self.max_bytes and self.frames:
+                self.frame_bytes -= len(self.frames.popleft()[2])
+
+    def dump(self, directory, device, reason):
+        '''Writes everything recorded so far to a new directory.
+
+        Arguments:
+            directory {str} -- Where to create it.
+            device {str} -- Device the recording is of, part of its name.
+            reason {str} -- Why, written down along with the events.
+
+        Returns:
+            {str} -- The directory the frames and events.jsonl went to.
+        '''
+        for future in self.pending:
+            if future.exception() is not None:
+                logger.error('Could not record a frame: %r', future.exception())
+        path = os.path.join(directory, '{}-{}-{}'.format(device, time.strftime('%Y%m%d-%H%M%S'), self.frames_seen))
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            frames = list(self.frames)
+        for number, at, data in frames:
+            with open(os.path.join(path, 'frame-{:06d}.jpg'.format(number)), 'wb') as f:
+                f.write(data)
+        with open(os.path.join(path, 'events.jsonl'), 'w') as f:
+            f.write(json.dumps({'at': time.time(), 'kind': 'dump', 'reason': reason, 'frames_seen': self.frames_seen,
+                                'frames_dropped': self.dropped}) + '\n')
+            for at, frame, kind, data in self.events:
+                f.write(json.dumps(dict(data, at=at, frame=frame, kind=kind), default=str) + '\n')
+        logger.warning('Dumped the last %d frames and %d events to %s (%s)', len(frames), len(self.events), path, reason)
+        return path
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
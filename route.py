@@ -0,0 +1,199 @@
+#!/usr/bin/env python3.7
+'''Reorders a quest list so that the summed cooldown between stops is as small as possible.
+
+Usage: ./route.py quest_list.txt -o quest_list.optimized.txt
+'''
+import argparse
+import itertools
+import logging
+
+import numpy as np
+from colorlog import ColoredFormatter
+
+from cooldown import calculateCDArray, calculateMatrix
+from stops import format_coord, load_stops
+
+logger = logging.getLogger('route')
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = ColoredFormatter("  %(log_color)s%(levelname)-8s%(reset)s | %(log_color)s%(message)s%(reset)s")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+def cost_matrix(coords, stop_seconds=30, margin=1.10):
+    '''Seconds it takes to go from each stop to every other one: the
+    cooldown (with the same safety margin Main.start uses), or the time
+    spent on the stop itself if that's longer.
+    '''
+    minutes = calculateCDArray(calculateMatrix(coords))
+    return np.maximum(minutes * 60 * margin, stop_seconds)
+
+
+def route_cost(cost, order):
+    order = np.asarray(order)
+    return float(cost[order[:-1], order[1:]].sum())
+
+
+def solve_exact(cost):
+    '''Held-Karp over every subset of stops. Only usable for small N.
+
+    Returns:
+        {list} -- The best order, as indexes into cost.
+    '''
+    n = len(cost)
+    best = np.full((1 << n, n), np.inf)
+    parent = np.full((1 << n, n), -1, dtype=int)
+    for i in range(n):
+        best[1 << i, i] = 0
+    for mask in range(1, 1 << n):
+        row = best[mask]
+        if not np.isfinite(row).any():
+            continue
+        # Cheapest way to reach every j from any last stop i of mask.
+        totals = row[:, None] + cost
+        last = totals.argmin(axis=0)
+        reach = totals[last, np.arange(n)]
+        for j in range(n):
+            if mask & (1 << j):
+                continue
+            new_mask = mask | (1 << j)
+            if reach[j] < best[new_mask, j]:
+                best[new_mask, j] = reach[j]
+                parent[new_mask, j] = last[j]
+
+    full = (1 << n) - 1
+    j = int(best[full].argmin())
+    order, mask = [], full
+    while j != -1:
+        order.append(j)
+        j, mask = int(parent[mask, j]), mask & ~(1 << j)
+    return order[::-1]
+
+
+def nearest_neighbour(cost, start):
+    n = len(cost)
+    visited = np.zeros(n, dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, cost[order[-1]])
+        order.append(int(row.argmin()))
+        visited[order[-1]] = True
+    return order
+
+
+def two_opt(cost, tour):
+    '''Reverses tour segments while that makes the (closed) tour cheaper.'''
+    tour = np.array(tour)
+    n = len(tour)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            a, b = tour[i - 1], tour[i]
+            c, d = tour[i + 1:], np.roll(tour, -1)[i + 1:]
+            delta = cost[a, c] + cost[b, d] - cost[a, b] - cost[c, d]
+            j = int(delta.argmin())
+            if delta[j] < -1e-9:
+                tour[i:i + j + 2] = tour[i:i + j + 2][::-1]
+                improved = True
+    return tour
+
+
+def or_opt(cost, tour, max_length=3):
+    '''Moves segments of up to max_length stops elsewhere in the (closed)
+    tour, possibly reversed, while that makes it cheaper.
+    '''
+    tour = list(tour)
+    n = len(tour)
+    improved = True
+    while improved:
+        improved = False
+        for length, i in itertools.product(range(1, max_length + 1), range(1, n)):
+            if i + length >= n:
+                continue
+            segment = tour[i:i + length]
+            prev, after = tour[i - 1], tour[(i + length) % n]
+            gain = cost[prev, segment[0]] + cost[segment[-1], after] - cost[prev, after]
+
+            rest = np.array(tour[:i] + tour[i + length:])
+            left, right = rest, np.roll(rest, -1)
+            forward = cost[left, segment[0]] + cost[segment[-1], right] - cost[left, right]
+            backward = cost[left, segment[-1]] + cost[segment[0], right] - cost[left, right]
+            k_forward, k_backward = int(forward.argmin()), int(backward.argmin())
+            if min(forward[k_forward], backward[k_backward]) < gain - 1e-9:
+                if forward[k_forward] <= backward[k_backward]:
+                    k = k_forward
+                else:
+                    k, segment = k_backward, segment[::-1]
+                rest = list(rest)
+                tour = rest[:k + 1] + segment + rest[k + 1:]
+                improved = True
+    return tour
+
+
+def solve(cost, exact_below=13, starts=8):
+    '''Finds a cheap order to visit every stop once, starting anywhere.
+
+    Small lists are solved exactly, bigger ones with nearest
+    neighbour from a few starting stops, then 2-opt and Or-opt.
+
+    Returns:
+        {list} -- The order, as indexes into cost.
+    '''
+    n = len(cost)
+    if n < 3:
+        return list(range(n))
+    if n < exact_below:
+        return solve_exact(cost)
+
+    # A dummy stop that costs nothing to reach or leave turns the open
+    # route into a closed tour, which is what 2-opt and Or-opt work on.
+    closed = np.zeros((n + 1, n + 1))
+    closed[:n, :n] = cost
+
+    best = None
+    for start in np.linspace(0, n - 1, min(starts, n)).astype(int):
+        tour = [n] + nearest_neighbour(cost, int(start))
+        tour = list(two_opt(closed, tour))
+        tour = or_opt(closed, tour)
+        i = tour.index(n)
+        order = tour[i + 1:] + tour[:i]
+        if best is None or route_cost(cost, order) < route_cost(cost, best):
+            best = order
+    return best
+
+
+def format_duration(seconds):
+    return '{:d}h{:02d}m'.format(int(seconds // 3600), int(seconds % 3600 // 60))
+
+
+def main(args):
+    stops = load_stops(args.quest_list)
+    cost = cost_matrix(stops.coords, args.stop_seconds)
+    order = solve(cost, args.exact_below)
+
+    before, after = route_cost(cost, list(range(len(stops)))), route_cost(cost, order)
+    logger.info('%d stops. Expected run time: %s in file order, %s optimized (%.0f%% less).',
+                len(stops), format_duration(before), format_duration(after),
+                100 * (before - after) / before if before else 0)
+
+    with open(args.output, 'w') as file:
+        file.write(''.join(format_coord(stops[i]) + '\n' for i in order))
+    logger.info('Wrote %s', args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reorders a quest list to minimize the total cooldown time.')
+    parser.add_argument('quest_list', type=str, nargs='?', default='quest_list.txt',
+                        help="Quest list to optimize, in any format stops.py reads.")
+    parser.add_argument('-o', '--output', type=str, default='quest_list.optimized.txt',
+                        help="Where to write the reordered list.")
+    parser.add_argument('--stop-seconds', type=float, default=30,
+                        help="Seconds spent on each stop (teleport, loading, spinning), the minimum cost of any leg.")
+    parser.add_argument('--exact-below', type=int, default=13,
+                        help="Lists with fewer stops than this are solved exactly.")
+    args = parser.parse_args()
+
+    main(args)
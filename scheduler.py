@@ -0,0 +1,76 @@
+'''Cooldown bookkeeping for the spin loop.
+'''
+import asyncio
+import logging
+import time
+
+from cooldown import CooldownModel
+
+logger = logging.getLogger('ivcheck')
+
+
+class Clock(object):
+    '''The real clock.'''
+    def time(self):
+        return time.time()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+class SimulatedClock(object):
+    '''A clock that jumps forward instead of sleeping, so a whole
+    route's worth of cooldowns can be simulated in no time.
+    '''
+    def __init__(self, now=0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += max(0, seconds)
+        await asyncio.sleep(0)
+
+
+class CooldownScheduler(object):
+    '''Works out when each stop can be spun at the earliest.
+
+    The cooldown only depends on where and when the last spin
+    happened, so the bot can teleport to the next stop right away and
+    let the map load and the pre-spin checks run while the cooldown
+    runs down, waiting only for whatever is left of it right before
+    spinning.
+
+    Keyword Arguments:
+        clock {Clock} -- Where time comes from (default: the real one).
+        model {CooldownModel} -- The cooldown table and last spin (default:
+                                 one with a 10% margin and at least 5 seconds
+                                 between spins).
+    '''
+    def __init__(self, clock=None, model=None):
+        self.clock = clock or Clock()
+        self.model = model or CooldownModel(margin=1.10, min_wait=5)
+
+    def record_spin(self, coords, at=None):
+        '''Starts the cooldown, from a spin at coords (now, or at the given time).'''
+        self.model.record_spin(coords, self.clock.time() if at is None else at)
+
+    def cooldown(self, coords):
+        '''Seconds that must pass between the last spin and one at coords.'''
+        return self.model.cooldown(coords)
+
+    def earliest_spin_time(self, coords):
+        legal_at = self.model.legal_at(coords)
+        return self.clock.time() if legal_at is None else legal_at
+
+    def seconds_until_legal(self, coords):
+        return self.model.seconds_until_legal(coords, self.clock.time())
+
+    async def wait_until_legal(self, coords, log_every=30):
+        '''Sleeps until a spin at coords won't break the cooldown.'''
+        remaining = self.seconds_until_legal(coords)
+        while remaining > 0:
+            logger.info('%.0f seconds to go...', remaining)
+            await self.clock.sleep(min(remaining, log_every))
+            remaining = self.seconds_until_legal(coords)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3.7
+'''Recognizes screen elements by comparing config boxes
+against reference crops recorded from a live session,
+which is way faster than running them through OCR.
+
+Templates live in TEMPLATES_DIR/<resolution>/<location>/*.png,
+e.g. templates/1080x2160/oh_hatching_box/1554139200.png
+
+To record the ones that are showing right now on the phone:
+    ./states.py im_a_passenger_button_box [more locations...]
+'''
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+import numpy as np
+import yaml
+from colorlog import ColoredFormatter
+from PIL import Image
+
+from pokemonlib import PokemonGo
+
+logger = logging.getLogger('states')
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = ColoredFormatter("  %(log_color)s%(levelname)-8s%(reset)s | %(log_color)s%(message)s%(reset)s")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+TEMPLATES_DIR = 'templates'
+
+
+def fingerprint(im, size=(32, 16)):
+    '''Shrinks an image into a zero-mean, unit-length grayscale vector,
+    so the dot product of two fingerprints is their normalized cross
+    correlation, from -1 to 1.
+
+    Returns:
+        {ndarray} -- The fingerprint, or None if the image is a flat color.
+    '''
+    pixels = np.asarray(im.convert('L').resize(size, Image.BILINEAR), dtype=np.float32).ravel()
+    pixels = pixels - pixels.mean()
+    norm = np.linalg.norm(pixels)
+    if norm < 1e-3:
+        return None
+    return pixels / norm
+
+
+class StateClassifier(object):
+    '''Tells whether a config location currently shows the same thing
+    as its recorded templates.
+
+    Scores at or above `match` count as present, at or below `mismatch`
+    as absent, anything in between is left for OCR to decide.
+    '''
+    def __init__(self, directory=TEMPLATES_DIR, match=0.9, mismatch=0.6):
+        self.directory = directory
+        self.match = match
+        self.mismatch = mismatch
+        self.resolution = None
+        self.templates = {}
+
+    def load(self, resolution):
+        '''Loads every template recorded for the given resolution.'''
+        self.resolution = resolution
+        self.templates = {}
+        path = os.path.join(self.directory, resolution)
+        if not os.path.isdir(path):
+            logger.info('No templates for %s, everything will go through OCR.', resolution)
+            return
+        for location in sorted(os.listdir(path)):
+            for name in sorted(os.listdir(os.path.join(path, location))):
+                with Image.open(os.path.join(path, location, name)) as im:
+                    self.add(location, im)
+        logger.info('Loaded templates for %s: %s', resolution, ', '.join(
+            '{} ({})'.format(location, len(fingerprints)) for location, fingerprints in self.templates.items()))
+
+    def add(self, location, im):
+        vector = fingerprint(im)
+        if vector is not None:
+            self.templates.setdefault(location, []).append(vector)
+
+    def record(self, location, im):
+        '''Saves im as a new template for location and starts using it right away.'''
+        path = os.path.join(self.directory, self.resolution, location)
+        os.makedirs(path, exist_ok=True)
+        filename = os.path.join(path, '{}.png'.format(int(time.time() * 1000)))
+        im.save(filename)
+        self.add(location, im)
+        logger.info('Recorded template %s', filename)
+
+    def score(self, location, im):
+        '''Returns the best correlation of im against location's templates,
+        or None if there are no templates for it.
+        '''
+        if location not in self.templates:
+            return None
+        vector = fingerprint(im)
+        if vector is None:
+            return 0.0
+        return float(np.max(np.dot(self.templates[location], vector)))
+
+    def detect(self, location, im):
+        '''Returns:
+            {bool} -- Whether location shows the same as its templates.
+            {None} -- If there are no templates or it's not sure.
+        '''
+        score = self.score(location, im)
+        if score is None:
+            return None
+        logger.debug('Template score for %s: %.3f', location, score)
+        if score >= self.match:
+            return True
+        if score <= self.mismatch:
+            return False
+        return None
+
+
+async def record_templates(args):
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+    p = PokemonGo()
+    await p.set_device(args.device_id)
+    classifier = StateClassifier(args.templates)
+    classifier.resolution = await p.get_resolution()
+    crops = await p.capture_regions({location: config['locations'][location] for location in args.locations})
+    for location, crop in crops.items():
+        classifier.record(location, crop)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Records the given config locations, as they are showing right now, as templates.')
+    parser.add_argument('locations', nargs='+',
+                        help="Config locations to record, e.g. oh_hatching_box")
+    parser.add_argument('--device-id', type=str, default=None,
+                        help="Optional, if not specified the phone is automatically detected.")
+    parser.add_argument('--config', type=str, default='config.yaml',
+                        help="Config file location.")
+    parser.add_argument('--templates', type=str, default=TEMPLATES_DIR,
+                        help="Templates directory.")
+    args = parser.parse_args()
+
+    asyncio.run(record_templates(args))
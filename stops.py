@@ -0,0 +1,370 @@
+#!/usr/bin/env python3.7
+'''Loads lists of pokestops, once, and fast.
+
+A list can be plain lat,lng lines, Google Maps links, a CSV with
+latitude and longitude columns or a GPX file. It is parsed and
+validated up front, near-identical stops are merged, and the result
+is cached next to it as a binary array, so loading it again (even
+with tens of thousands of stops) only takes a few milliseconds, until
+the file changes.
+
+Usage: ./stops.py quest_list.gpx -o quest_list.txt
+'''
+import argparse
+import csv
+import io
+import logging
+import math
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+from colorlog import ColoredFormatter
+
+from cooldown import EARTH_RADIUS
+
+logger = logging.getLogger('stops')
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = ColoredFormatter("  %(log_color)s%(levelname)-8s%(reset)s | %(log_color)s%(message)s%(reset)s")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# Bump whenever parsing changes, so old caches are thrown away.
+CACHE_VERSION = 3
+# Along a meridian.
+KM_PER_DEGREE = EARTH_RADIUS / 1000 * math.pi / 180
+
+# Anything float() reads as a finite number, like splitCoords did: 35.28, 35., .5, 1e1...
+NUMBER = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+# A comma in a link, maybe URL encoded, and maybe followed by (encoded) spaces.
+URL_COMMA = r'(?:,|%2C)(?:\s|%20|\+)*'
+# lat,lng or lat,lng,alt as exported by GPS apps; the altitude is dropped.
+RE_COORD = re.compile(r'^\s*' + NUMBER + r'\s*[,;\s]\s*' + NUMBER + r'(?:\s*[,;\s]\s*' + NUMBER + r')?\s*$')
+RE_URL_COORDS = [
+    re.compile(r'!3d' + NUMBER + r'!4d' + NUMBER),                              # .../data=!3d35.28!4d139.66
+    re.compile(r'[?&](?:q|ll|query|destination|center)=' + NUMBER + URL_COMMA + NUMBER),  # ?q=35.28,139.66
+    re.compile(r'@' + NUMBER + URL_COMMA + NUMBER),                             # .../@35.28,139.66,17z
+]
+LATITUDE_COLUMNS = ('lat', 'latitude', 'y')
+LONGITUDE_COLUMNS = ('lng', 'lon', 'long', 'longitude', 'x')
+
+
+def distance_km(lat, lng, lats, lngs):
+    '''Haversine distances from one point to many, unrounded.'''
+    rlat, rlats = np.radians(lat), np.radians(lats)
+    a = np.sin((rlat - rlats) / 2) ** 2 + np.sin(np.radians(lng - lngs) / 2) ** 2 * np.cos(rlat) * np.cos(rlats)
+    return EARTH_RADIUS / 1000 * 2 * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class StopListError(Exception):
+    # logger.error('No valid stops in the list')
+    pass
+
+
+def parse_coord(text):
+    '''Reads a coordinate from a lat,lng pair (maybe followed by an
+    altitude) or a Google Maps link.
+
+    Numbers are read like splitCoords read them (35.28, 35., .5, 1e1...),
+    except for nan and inf, which are no coordinate.
+
+    Returns:
+        {tuple} -- (lat, lng), or None if there's no coordinate in text.
+    '''
+    match = RE_COORD.match(text)
+    if match is None and '://' in text:
+        for pattern in RE_URL_COORDS:
+            match = pattern.search(text)
+            if match:
+                break
+    if match is None:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+
+def parse_lines(text):
+    '''Returns:
+        {list} -- (line number, coordinate or None) for each non empty line.
+    '''
+    return [(number, parse_coord(line)) for number, line in enumerate(text.splitlines(), start=1)
+            if line.strip() and not line.lstrip().startswith('#')]
+
+
+def parse_csv(text):
+    '''Reads the latitude and longitude columns of a CSV, or the first
+    two if there is no header naming them.
+    '''
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], ',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    rows = list(csv.reader(io.StringIO(text), dialect))
+    header = [column.strip().lower() for column in rows[0]] if rows else []
+    lat = next((header.index(name) for name in LATITUDE_COLUMNS if name in header), None)
+    lng = next((header.index(name) for name in LONGITUDE_COLUMNS if name in header), None)
+    first = 1
+    if lat is None or lng is None:
+        lat, lng, first = 0, 1, 0
+    parsed = []
+    for number, row in enumerate(rows[first:], start=first + 1):
+        if not row:
+            continue
+        try:
+            parsed.append((number, (float(row[lat]), float(row[lng]))))
+        except (IndexError, ValueError):
+            parsed.append((number, None))
+    return parsed
+
+
+def parse_gpx(text):
+    '''Reads every waypoint, route point and track point of a GPX.'''
+    points = [element for element in ElementTree.fromstring(text).iter()
+              if element.tag.rsplit('}', 1)[-1] in ('wpt', 'rtept', 'trkpt')]
+    parsed = []
+    for number, point in enumerate(points, start=1):
+        try:
+            parsed.append((number, (float(point.get('lat')), float(point.get('lon')))))
+        except (TypeError, ValueError):
+            parsed.append((number, None))
+    return parsed
+
+
+def parse(filename):
+    '''Reads the stops in a file, in any of the supported formats.
+
+    Returns:
+        {ndarray} -- N x 2 array of latitudes and longitudes, only the
+                     valid ones, in file order.
+    '''
+    with open(filename, 'r', encoding='utf-8-sig') as f:
+        text = f.read()
+    head = text.lstrip()[:100].lower()
+    if filename.lower().endswith('.gpx') or head.startswith('<?xml') or head.startswith('<gpx'):
+        parsed = parse_gpx(text)
+    elif filename.lower().endswith('.csv'):
+        parsed = parse_csv(text)
+    else:
+        parsed = parse_lines(text)
+
+    coords = []
+    for number, coord in parsed:
+        if coord is None:
+            logger.warning('Skipping %s:%d, not a coordinate', filename, number)
+        elif not (-90 <= coord[0] <= 90 and -180 <= coord[1] <= 180) or coord == (0, 0):
+            logger.warning('Skipping %s:%d, %s,%s is not a valid coordinate', filename, number, *coord)
+        else:
+            coords.append(coord)
+    return np.array(coords, dtype=float).reshape(-1, 2)
+
+
+def dedupe(coords, meters=5):
+    '''Drops every stop closer than meters to an earlier one.
+
+    Returns:
+        {ndarray} -- The stops that are left, in the same order.
+    '''
+    if meters <= 0 or len(coords) < 2:
+        return coords
+    cell = meters / 1000 / KM_PER_DEGREE
+    grid = {}
+    keep = []
+    for i, (lat, lng) in enumerate(coords):
+        row, column = int(math.floor(lat / cell)), int(math.floor(lng / cell))
+        # A degree of longitude shrinks away from the equator, so look further sideways.
+        reach = int(math.ceil(1 / max(math.cos(math.radians(abs(lat) + cell)), 1e-6)))
+        neighbours = [j for r in (row - 1, row, row + 1) for c in range(column - reach, column + reach + 1)
+                      for j in grid.get((r, c), ())]
+        if neighbours:
+            near = coords[neighbours]
+            if (distance_km(lat, lng, near[:, 0], near[:, 1]) * 1000 < meters).any():
+                continue
+        grid.setdefault((row, column), []).append(i)
+        keep.append(i)
+    return coords[keep]
+
+
+class GridIndex(object):
+    '''Buckets stops into a grid of square-ish cells, to find the ones
+    near a point without looking at all of them. Doesn't wrap around
+    the antimeridian.
+
+    Arguments:
+        coords {ndarray} -- N x 2 array of latitudes and longitudes.
+
+    Keyword Arguments:
+        cell_km {float} -- Height of the cells (default: 1).
+    '''
+    def __init__(self, coords, cell_km=1.0):
+        self.coords = coords
+        self.cell = cell_km / KM_PER_DEGREE
+        self.cell_km = cell_km
+        rows = np.floor(coords[:, 0] / self.cell).astype(np.int64)
+        columns = np.floor(coords[:, 1] / self.cell).astype(np.int64)
+        order = np.lexsort((columns, rows))
+        keys = np.stack([rows[order], columns[order]], axis=1)
+        unique, starts = np.unique(keys, axis=0, return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self.cells = {(int(r), int(c)): order[start:end] for (r, c), start, end in zip(unique, starts, ends)}
+        self.bounds = (rows.min(), rows.max(), columns.min(), columns.max()) if len(coords) else (0, -1, 0, -1)
+
+    def near(self, lat, lng, rings):
+        '''Finds the stops in the cells up to rings cells away from (lat, lng).
+
+        Returns:
+            {tuple} -- (indexes, km, everything): the stops, how far from
+                       (lat, lng) the searched box reaches at least, and
+                       whether the box covers every stop.
+        '''
+        row, column = int(math.floor(lat / self.cell)), int(math.floor(lng / self.cell))
+        # A degree of longitude shrinks away from the equator, so look further sideways.
+        top = min(abs(lat) + (rings + 1) * self.cell, 89.9)
+        reach = int(math.ceil(rings / math.cos(math.radians(top))))
+        rows, columns = (row - rings, row + rings), (column - reach, column + reach)
+        min_row, max_row, min_column, max_column = self.bounds
+        everything = rows[0] <= min_row and rows[1] >= max_row and columns[0] <= min_column and columns[1] >= max_column
+        if (2 * rings + 1) * (2 * reach + 1) > len(self.cells):
+            found = [indexes for (r, c), indexes in self.cells.items()
+                     if rows[0] <= r <= rows[1] and columns[0] <= c <= columns[1]]
+        else:
+            found = [self.cells[(r, c)] for r in range(rows[0], rows[1] + 1)
+                     for c in range(columns[0], columns[1] + 1) if (r, c) in self.cells]
+        indexes = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+        return indexes, rings * self.cell_km, everything
+
+    def nearest(self, lat, lng, max_km=None, exclude=None):
+        '''Finds the closest stop to (lat, lng).
+
+        Keyword Arguments:
+            max_km {float} -- Only look this far (default: anywhere).
+            exclude {ndarray} -- Boolean mask of stops to skip, e.g. the visited ones.
+
+        Returns:
+            {tuple} -- (index, km), or None if there's nothing in range.
+        '''
+        rings = 0
+        while True:
+            indexes, covered, everything = self.near(lat, lng, rings)
+            if exclude is not None:
+                indexes = indexes[~exclude[indexes]]
+            best = None
+            if len(indexes):
+                dist = distance_km(lat, lng, self.coords[indexes, 0], self.coords[indexes, 1])
+                i = int(dist.argmin())
+                best = (int(indexes[i]), float(dist[i]))
+            out_of_range = max_km is not None and covered >= max_km
+            # Anything outside the box is at least covered km away.
+            if everything or out_of_range or (best is not None and best[1] <= covered):
+                if best is None or (max_km is not None and best[1] > max_km):
+                    return None
+                return best
+            rings = max(1, rings * 2)
+
+
+class Stops(object):
+    '''A parsed, validated and deduplicated list of stops.
+
+    Arguments:
+        coords {ndarray} -- N x 2 array of latitudes and longitudes.
+    '''
+    def __init__(self, coords, source=None):
+        self.coords = coords
+        self.source = source
+        self.visited = np.zeros(len(coords), dtype=bool)
+        self._index = None
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __iter__(self):
+        return iter(self.coords.tolist())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return Stops(self.coords[item], self.source)
+        return self.coords[item].tolist()
+
+    @property
+    def index(self):
+        '''The GridIndex of the stops, built the first time it's needed.'''
+        if self._index is None:
+            self._index = GridIndex(self.coords)
+        return self._index
+
+    def nearest_unvisited(self, coords, max_km=None):
+        '''Returns:
+            {tuple} -- (index, km) of the closest stop to coords not
+                       marked in self.visited yet, or None.
+        '''
+        return self.index.nearest(coords[0], coords[1], max_km, self.visited)
+
+
+def cache_filename(filename):
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, '.{}.stops.npz'.format(name))
+
+
+def load_stops(filename, dedupe_meters=5, cache=True):
+    '''Loads a list of stops, from its cache if the file didn't change
+    since it was last parsed.
+
+    Keyword Arguments:
+        dedupe_meters {float} -- Stops closer than this to an earlier one are dropped (default: 5).
+        cache {bool} -- Whether to use and write the cache (default: True).
+
+    Returns:
+        {Stops}
+    '''
+    stat = os.stat(filename)
+    key = np.array([CACHE_VERSION, stat.st_mtime_ns, stat.st_size, dedupe_meters], dtype=float)
+    cached = cache_filename(filename)
+    if cache:
+        try:
+            with np.load(cached) as data:
+                if np.array_equal(data['key'], key):
+                    return Stops(data['coords'], filename)
+        except (OSError, KeyError, ValueError):
+            pass
+
+    coords = parse(filename)
+    total = len(coords)
+    coords = dedupe(coords, dedupe_meters)
+    if total != len(coords):
+        logger.info('Merged %d stops that were less than %gm away from another one', total - len(coords), dedupe_meters)
+    if not len(coords):
+        logger.error('No valid stops in %s', filename)
+        raise StopListError(filename)
+
+    if cache:
+        try:
+            # np.savez adds .npz to names without it, so write through a file object.
+            with open(cached + '.tmp', 'wb') as f:
+                np.savez(f, key=key, coords=coords)
+            os.replace(cached + '.tmp', cached)
+        except OSError as e:
+            logger.debug("Couldn't write the stops cache: %s", e)
+    return Stops(coords, filename)
+
+
+def format_coord(coord):
+    return '{:.6f},{:.6f}'.format(*coord)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parses, validates and deduplicates a list of stops, and writes it as plain lat,lng lines.')
+    parser.add_argument('stops', type=str,
+                        help="Lat,lng lines, Google Maps links, CSV or GPX.")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="Where to write the clean list (default: just check it).")
+    parser.add_argument('--dedupe-meters', type=float, default=5,
+                        help="Stops closer than this to an earlier one are dropped.")
+    args = parser.parse_args()
+
+    stops = load_stops(args.stops, args.dedupe_meters)
+    logger.info('%d stops in %s', len(stops), args.stops)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(''.join(format_coord(coord) + '\n' for coord in stops))
+        logger.info('Wrote %s', args.output)
@@ -2,60 +2,31 @@
 import logging
 import asyncio
 from PIL import Image
-import colorsys
 
 from pokemonlib import PokemonGo
+from vision import classify_hues
 p = PokemonGo()
 
 async def hue_affinity(hue1, hue2):
-    '''Checks the affinity, in percentual terms,
-    of the average median im hue against hue1 and
-    hue2.
+    '''Grabs the bottom pokestop bar from the phone and
+    checks whether its hue is closer to hue1 or hue2.
 
     Input values are in range 0-255, instead of
     the common 0-360° used for HSL and HSV images.
 
     Arguments:
-        image {Image}   -- PIL.Image
         hue1  {int}     -- 0-255
         hue2  {int}     -- 0-255
 
     Returns:
-        {tuple}   -- A tuple containing the relative
-                        percentages lenghts of the arcs
-                        between im's median hue against
-                        hue1 and hue2, respectively.
+        {bool|None}   -- True if closer to hue1, False if
+                         closer to hue2, None if it can't tell.
     '''
-    ## Image filtering mumbojumbo
-    im = await p.screencap()
-    im = im.crop([240, 1958, 290, 1985])
-    # im = im.quantize()
-    im = im.quantize()
+    im = (await p.capture_regions({'bar': [240, 1958, 290, 1985]}))['bar']
     im.show()
-    im = im.resize((1, 1))
-    im = im.convert('HSV')
-    pixel = im.getpixel((0, 0))
+    result, hue, confidence = classify_hues([im], hue1, hue2)[0]
 
-    ## Gets us one only int, the average hue of the image
-    hue = pixel[0]
-
-    ## The Angles
-    # The modulus makes it a polar function, i.e.:
-    # everything that overflows or underflows 255
-    # becomes the difference, so we don't need to
-    # translate values nor calculate distances :)
-    a1 = abs(hue-hue1) % 255
-    a2 = abs(hue-hue2) % 255
-
-
-    logging.info('Detected H:%s (%i%% of H1: %s | %i%% of H2: %s)', hue, a1, hue1, a2, hue2)
-
-    if a1 < a2:
-        return True
-        # return ((((a1 + hue) / hue) - 1) * 100, (((a2 + hue) / hue) - 1) * 100)
-    if a2 < a1:
-        return False
-        # return ((((a1 + hue) / hue) - 1) * 100, (((a2 + hue) / hue) - 1) * 100)
-        raise Exception("Well you got unlucky boy, it's right on the middle")
+    logging.info('Detected H:%i (H1: %s | H2: %s) with a confidence of %i%%', hue, hue1, hue2, confidence * 100)
+    return result
 
 asyncio.run(hue_affinity(130, 200))
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules live at the top of the repo, not in a package.
+sys.path.insert(0, HERE)
+
+
+@pytest.fixture
+def fake_phone(tmp_path, monkeypatch):
+    '''Puts fakeadb first on PATH, simulating a single phone.'''
+    adb = tmp_path / 'adb'
+    adb.write_text('#!/bin/sh\nexec {} {} "$@"\n'.format(sys.executable, os.path.join(HERE, 'fakeadb.py')))
+    adb.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('FAKEADB_DIR', str(tmp_path / 'devices'))
+    monkeypatch.setenv('FAKEADB_DEVICES', 'fake0')
+    monkeypatch.setenv('FAKEADB_CONFIG', os.path.join(HERE, 'config.yaml'))
+    return 'fake0'
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from cooldown import COOLDOWN_TABLE, CooldownModel, calculateCD, calculateCDArray
+
+EPSILON = 1e-6
+BREAKPOINTS = [(i, km) for i, (km, minutes) in enumerate(COOLDOWN_TABLE)]
+
+
+def expected_minutes(dist):
+    '''Straight from the table: the last breakpoint at or below dist.'''
+    minutes = 0
+    for km, cooldown in COOLDOWN_TABLE:
+        if dist >= km:
+            minutes = cooldown
+    return minutes
+
+
+@pytest.mark.parametrize('i, km', BREAKPOINTS)
+def test_breakpoints(i, km):
+    model = CooldownModel()
+    below = COOLDOWN_TABLE[i - 1][1] if i else 0
+    at = COOLDOWN_TABLE[i][1]
+    for dist, minutes in [(km - EPSILON, below), (km, at), (km + EPSILON, at)]:
+        assert calculateCD(dist) == minutes
+        assert model.cooldown_minutes(dist) == minutes
+        assert calculateCDArray(dist) == minutes
+
+
+def test_same_as_calculateCD_everywhere():
+    rng = np.random.RandomState(0)
+    model = CooldownModel()
+    edges = np.array([km for km, minutes in COOLDOWN_TABLE])
+    dists = np.concatenate([rng.uniform(0, 2000, 5000), np.round(rng.uniform(0, 2000, 5000), 2),
+                            edges - EPSILON, edges, edges + EPSILON, [0, 1e9]])
+    for dist in dists:
+        assert model.cooldown_minutes(dist) == calculateCD(dist) == expected_minutes(dist)
+    assert list(calculateCDArray(dists)) == [calculateCD(dist) for dist in dists]
+
+
+def test_cooldown_seconds():
+    model = CooldownModel(margin=1.1, min_wait=5)
+    assert model.cooldown([0, 0]) == 0
+    model.record_spin([0, 0], at=100)
+    assert model.cooldown([0, 0]) == 5
+    # About 11.1km along the equator.
+    assert model.cooldown([0, 0.1]) == pytest.approx(6 * 60 * 1.1)
+    assert model.seconds_until_legal([0, 0.1], now=200) == pytest.approx(100 + 6 * 60 * 1.1 - 200)
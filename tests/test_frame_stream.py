@@ -0,0 +1,64 @@
+import asyncio
+import struct
+
+import pytest
+
+from pokemonlib import AdbTimeoutError, FrameStream, FrameStreamNotRunningError
+
+WIDTH, HEIGHT = 4, 2
+
+
+def record(path, frames):
+    '''Writes a raw screencap stream, every frame filled with its number.'''
+    with open(path, 'wb') as f:
+        for number in range(frames):
+            f.write(struct.pack('<4I', WIDTH, HEIGHT, 1, 0))
+            f.write(bytes([number % 256]) * (WIDTH * HEIGHT * 4))
+
+
+def test_replays_a_recorded_stream(tmp_path):
+    path = tmp_path / 'recording.raw'
+    record(path, 10)
+
+    async def main():
+        stream = FrameStream(['cat', path], depth=10, reconnect=False, timeout=5)
+        await stream.start()
+        await stream.task
+        return stream
+
+    stream = asyncio.run(main())
+    assert stream.frames_read == 10
+    numbers = []
+    for captured_at, (width, height, rawmode, pixels) in stream.frames:
+        assert (width, height, rawmode) == (WIDTH, HEIGHT, 'RGBA')
+        assert len(set(bytes(pixels))) == 1
+        numbers.append(pixels[0])
+    assert numbers == list(range(10))
+    timestamps = [captured_at for captured_at, frame in stream.frames]
+    assert timestamps == sorted(timestamps)
+
+
+def test_gives_up_on_a_dead_source():
+    async def main():
+        stream = FrameStream(['false'], timeout=30, max_reconnects=2)
+        await stream.start()
+        try:
+            await stream.wait_for_frame()
+        finally:
+            await stream.stop()
+
+    with pytest.raises(FrameStreamNotRunningError):
+        asyncio.run(main())
+
+
+def test_times_out_waiting_for_a_frame():
+    async def main():
+        stream = FrameStream(['sleep', '10'], timeout=0.2)
+        await stream.start()
+        try:
+            await stream.wait_for_frame()
+        finally:
+            await stream.stop()
+
+    with pytest.raises(AdbTimeoutError):
+        asyncio.run(main())
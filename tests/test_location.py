@@ -0,0 +1,29 @@
+import fakeadb
+from cooldown import haversine
+from pokemonlib import parse_dumpsys_location
+
+# Trimmed from an Android 9 phone: the coarse entries come after the fine ones.
+ANDROID_9 = '''Location Manager State:
+  Location Listeners:
+  Active Records by Provider:
+    gps:
+  Last Known Locations:
+    gps: Location[gps 35.281374,139.663600 hAcc=5 et=+1d2h mock {Bundle[mParcelledData.dataSize=96]}]
+    network: Location[network 35.281370,139.663610 hAcc=20 et=+1d2h]
+  Last Known Locations Coarse Intervals:
+    gps: Location[gps 35.299000,139.663600 hAcc=2000 et=+1d1h mock]
+    network: Location[network 35.299000,139.663610 hAcc=2000 et=+1d1h]
+'''
+
+
+def test_fine_location_wins_over_coarse():
+    locations = parse_dumpsys_location(ANDROID_9)
+    assert locations == {'gps': [35.281374, 139.6636], 'network': [35.28137, 139.66361]}
+
+
+def test_simulated_phone():
+    assert parse_dumpsys_location(fakeadb.dumpsys_location(None)) == {}
+    locations = parse_dumpsys_location(fakeadb.dumpsys_location([-23.55, -46.63]))
+    assert set(locations) == {'gps', 'network', 'passive'}
+    for lat, lng in locations.values():
+        assert haversine(lat, lng, -23.55, -46.63) < 1
@@ -0,0 +1,19 @@
+import asyncio
+
+import pytest
+
+from pokemonlib import PokemonGo
+
+
+@pytest.mark.parametrize('attempt', range(3))
+def test_clipboard_right_after_starting_logcat(fake_phone, attempt):
+    async def main():
+        p = PokemonGo(timeout=10)
+        await p.set_device(fake_phone)
+        await p.start_logcat()
+        try:
+            return await p.get_clipboard()
+        finally:
+            await p.close()
+
+    assert asyncio.run(main()) == '0,0'
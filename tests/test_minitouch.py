@@ -0,0 +1,68 @@
+import asyncio
+import json
+import os
+
+from pokemonlib import Minitouch, MinitouchNotAvailableError, PokemonGo
+
+
+def inputs(device):
+    try:
+        with open(os.path.join(os.environ['FAKEADB_DIR'], device, 'state.json')) as f:
+            return json.load(f)['inputs']
+    except FileNotFoundError:
+        return 0
+
+
+async def wait_for_inputs(device, count):
+    # The daemon plays touches after they're sent, not before.
+    for _ in range(100):
+        if inputs(device) >= count:
+            return
+        await asyncio.sleep(0.05)
+
+
+def port_file(device):
+    return os.path.join(os.environ['FAKEADB_DIR'], device, 'minitouch.port')
+
+
+def test_restarts_when_the_daemon_dies(fake_phone):
+    async def main():
+        p = PokemonGo(touch='minitouch')
+        await p.set_device(fake_phone)
+        try:
+            await p.tap(10, 10)
+            await wait_for_inputs(fake_phone, 1)
+            first = p.minitouch
+            first.daemon.kill()
+            await first.daemon.wait()
+            await p.tap(10, 10)
+            await wait_for_inputs(fake_phone, 2)
+            assert p.minitouch is not first and p.touch == 'minitouch'
+        finally:
+            await p.close()
+
+    asyncio.run(main())
+    assert inputs(fake_phone) == 2
+    assert not os.path.exists(port_file(fake_phone))
+
+
+def test_falls_back_to_input_when_it_wont_restart(fake_phone, monkeypatch):
+    async def main():
+        p = PokemonGo(touch='minitouch')
+        await p.set_device(fake_phone)
+        try:
+            await p.tap(10, 10)
+            await wait_for_inputs(fake_phone, 1)
+            p.minitouch.daemon.kill()
+            await p.minitouch.daemon.wait()
+
+            async def start(self):
+                raise MinitouchNotAvailableError('gone')
+            monkeypatch.setattr(Minitouch, 'start', start)
+            await p.tap(10, 10)
+            assert p.minitouch is None and p.touch == 'input'
+        finally:
+            await p.close()
+
+    asyncio.run(main())
+    assert inputs(fake_phone) == 2
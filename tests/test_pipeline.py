@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import pytest
+
+from pokemonlib import CapturePipeline
+
+
+def counter(seconds):
+    '''A capture that takes the given time and returns how many came before.'''
+    count = 0
+
+    async def capture():
+        nonlocal count
+        await asyncio.sleep(seconds)
+        count += 1
+        return count
+
+    return capture
+
+
+def test_slower_than_max_age():
+    async def main():
+        pipeline = CapturePipeline(counter(0.3), max_age=0.2)
+        await pipeline.start()
+        try:
+            return await asyncio.wait_for(pipeline.get(), 2)
+        finally:
+            await pipeline.stop()
+
+    captured_at, frame = asyncio.run(main())
+    assert frame == 1
+
+
+def test_waits_for_a_frame_after_the_input():
+    async def main():
+        pipeline = CapturePipeline(counter(0.05))
+        await pipeline.start()
+        try:
+            first_at, first = await pipeline.get()
+            tapped_at = time.time()
+            captured_at, frame = await asyncio.wait_for(pipeline.get(tapped_at), 2)
+            return first, tapped_at, captured_at, frame
+        finally:
+            await pipeline.stop()
+
+    first, tapped_at, captured_at, frame = asyncio.run(main())
+    assert captured_at >= tapped_at
+    assert frame > first
+
+
+def test_never_hands_out_a_frame_twice():
+    async def main():
+        pipeline = CapturePipeline(counter(0.05), depth=2)
+        await pipeline.start()
+        try:
+            return [(await pipeline.get())[1] for i in range(5)]
+        finally:
+            await pipeline.stop()
+
+    frames = asyncio.run(main())
+    assert frames == sorted(set(frames))
+
+
+def test_raises_what_the_capture_raised():
+    async def fail():
+        raise ValueError('broken')
+
+    async def main():
+        pipeline = CapturePipeline(fail)
+        await pipeline.start()
+        try:
+            with pytest.raises(ValueError):
+                await asyncio.wait_for(pipeline.get(), 2)
+            assert pipeline.task is not None
+        finally:
+            await pipeline.stop()
+
+    asyncio.run(main())
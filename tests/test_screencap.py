@@ -0,0 +1,64 @@
+import asyncio
+import struct
+
+import pytest
+
+from pokemonlib import PhoneNotConnectedError, PokemonGo, TruncatedScreencapError, parse_raw_screencap
+
+FRAME = struct.pack('<4I', 2, 2, 1, 0) + bytes(16)
+RGB_565 = struct.pack('<4I', 2, 2, 4, 0) + bytes(8)
+
+
+def phone(*outputs):
+    '''A PokemonGo whose adb answers with outputs, (return code, stdout), in turn.'''
+    p = PokemonGo()
+    p.device_id = 'fake0'
+    outputs = list(outputs)
+
+    async def run(args, timeout=None):
+        return_code, stdout = outputs.pop(0)
+        return return_code, stdout, b'error: device offline' if return_code else b''
+    p.run = run
+    return p
+
+
+def test_parse_errors():
+    with pytest.raises(TruncatedScreencapError):
+        parse_raw_screencap(b'')
+    with pytest.raises(TruncatedScreencapError):
+        parse_raw_screencap(FRAME[:-8])
+    with pytest.raises(ValueError) as error:
+        parse_raw_screencap(struct.pack('<4I', 2, 2, 99, 0) + bytes(16))
+    assert not isinstance(error.value, TruncatedScreencapError)
+    with pytest.raises(ValueError) as error:
+        parse_raw_screencap(RGB_565)
+    assert not isinstance(error.value, TruncatedScreencapError)
+
+
+def test_hiccup_is_retried():
+    p = phone((0, b''), (0, FRAME))
+    assert asyncio.run(p.grab_raw_frame())[:3] == (2, 2, 'RGBA')
+    p = phone((1, b''), (0, FRAME))
+    assert asyncio.run(p.grab_raw_frame())[:3] == (2, 2, 'RGBA')
+    assert p.use_raw_screenshots
+
+
+def test_offline_raises_without_switching_to_png():
+    p = phone((1, b''), (0, b''))
+    with pytest.raises(PhoneNotConnectedError):
+        asyncio.run(p.grab_raw_frame())
+    assert p.use_raw_screenshots
+
+
+@pytest.mark.parametrize('frame', [struct.pack('<4I', 2, 2, 99, 0) + bytes(16), RGB_565])
+def test_unknown_format_switches_to_png(frame):
+    p = phone((0, frame))
+    assert asyncio.run(p.grab_raw_frame()) is None
+    assert not p.use_raw_screenshots
+
+
+@pytest.mark.parametrize('output', [(1, b''), (0, b''), (0, RGB_565)])
+def test_frame_stream_falls_back_to_one_at_a_time(output):
+    p = phone(output)
+    asyncio.run(p.start_frame_stream())
+    assert p.frame_stream is None
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from cooldown import splitCoords
+from stops import dedupe, parse_coord, parse_lines
+
+# Everything splitCoords, which read quest lists before stops.py, accepted.
+OLD_FORMS = [
+    '35.281374, 139.663600',
+    ' 35.281374,139.663600  ',
+    '35.,139.',
+    '1e1,2e1',
+    '-.5,+.25',
+    'https://maps.google.com/maps?q=35.28,139.66',
+    'https://maps.google.com/maps?q=35.28, 139.66',
+]
+
+
+@pytest.mark.parametrize('text', OLD_FORMS)
+def test_reads_what_splitCoords_did(text):
+    assert parse_coord(text) == tuple(splitCoords(text))
+
+
+@pytest.mark.parametrize('text, coord', [
+    ('https://www.google.com/maps/place/x/@35.28,139.66,17z', (35.28, 139.66)),
+    ('https://www.google.com/maps/place/x/data=!3d35.28!4d139.66', (35.28, 139.66)),
+    ('https://www.google.com/maps/search/?api=1&query=35.28%2C139.66', (35.28, 139.66)),
+    ('https://www.google.com/maps/search/?api=1&query=35.28%2C%20139.66', (35.28, 139.66)),
+    ('35.28;139.66', (35.28, 139.66)),
+    ('35.28 139.66', (35.28, 139.66)),
+    ('35.28,139.66,0', (35.28, 139.66)),
+    ('35.28, 139.66, 12.5', (35.28, 139.66)),
+])
+def test_other_forms(text, coord):
+    assert parse_coord(text) == coord
+
+
+@pytest.mark.parametrize('text', ['', 'hello', '35.28', '35.28,139.66,12,4', 'nan,nan', 'https://example.com/'])
+def test_not_a_coordinate(text):
+    assert parse_coord(text) is None
+
+
+def test_lines_skip_comments_and_blanks():
+    assert parse_lines('# stops\n\n1,2\nnope\n') == [(3, (1.0, 2.0)), (4, None)]
+
+
+def test_dedupe():
+    coords = np.array([(35.28, 139.66), (35.28001, 139.66), (35.29, 139.66)])
+    assert dedupe(coords, meters=5).tolist() == [[35.28, 139.66], [35.29, 139.66]]
@@ -0,0 +1,17 @@
+from PIL import Image
+
+from vision import ChangeDetector, classify_hues
+
+BLUE = (60, 150, 225)
+PURPLE = (115, 120, 230)
+
+
+def test_same_brightness_color_change_is_a_change():
+    blue, purple = Image.new('RGB', (40, 10), BLUE), Image.new('RGB', (40, 10), PURPLE)
+    assert classify_hues([blue, purple], 130, 200)[0][0] is True
+    assert classify_hues([blue, purple], 130, 200)[1][0] is False
+
+    changes = ChangeDetector()
+    assert changes.update({'bar': blue}) == {'bar'}
+    assert changes.update({'bar': blue}) == set()
+    assert changes.update({'bar': purple}) == {'bar'}
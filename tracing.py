@@ -0,0 +1,164 @@
+'''Timing spans for the hot paths of the bot.
+
+Wrap anything worth timing in a span:
+
+    with tracer.span('adb shell', device=device_id):
+        ...
+
+Every span is added to a histogram of its stage (per device), which
+can be written out in the Prometheus text format, and, if asked to,
+kept as an event for a Chrome trace (open it in chrome://tracing or
+https://ui.perfetto.dev).
+
+Tracing is off until enable() is called. While off, span() hands
+out the same do-nothing context manager every time, so leaving the
+spans in the hot paths costs next to nothing.
+'''
+import bisect
+import collections
+import json
+import os
+import time
+
+# Upper bounds, in seconds, of the histogram buckets.
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Span(object):
+    def __init__(self, tracer, name, device, args):
+        self.tracer = tracer
+        self.name = name
+        self.device = device
+        self.args = args
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.started, time.perf_counter() - self.started, self.device, self.args)
+        return False
+
+
+class Tracer(object):
+    '''Collects spans into per-stage histograms and, optionally, a
+    bounded list of trace events.
+
+    Keyword Arguments:
+        max_events {int} -- How many of the latest spans to keep for the
+                            Chrome trace (default: 100000).
+    '''
+    def __init__(self, max_events=100000):
+        self.enabled = False
+        self.keep_events = False
+        self.events = collections.deque(maxlen=max_events)
+        self.histograms = {}
+        self.origin = time.perf_counter()
+
+    def enable(self, events=False):
+        '''Starts recording spans.
+
+        Keyword Arguments:
+            events {bool} -- Also keep every span for a Chrome trace (default: False).
+        '''
+        self.enabled = True
+        self.keep_events = events
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name, device=None, **args):
+        '''Returns a context manager that times its block as a span of
+        stage name. Extra keyword arguments show up in the Chrome trace.
+        '''
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, device, args)
+
+    def record(self, name, started, seconds, device=None, args=None):
+        '''Records a span that was timed some other way.
+
+        Arguments:
+            name    {str}   -- Stage.
+            started {float} -- time.perf_counter() when it started.
+            seconds {float} -- How long it took.
+        '''
+        key = (name, device)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(seconds)
+        if self.keep_events:
+            self.events.append((name, device, started, seconds, args))
+
+    def chrome_trace(self):
+        '''Returns:
+            {dict} -- The recorded events in the Chrome trace event
+                      format, one thread per device.
+        '''
+        threads = {}
+        trace = []
+        for name, device, started, seconds, args in self.events:
+            if device not in threads:
+                threads[device] = len(threads) + 1
+                trace.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': threads[device],
+                              'args': {'name': device or 'main'}})
+            trace.append({'name': name, 'cat': name.split()[0], 'ph': 'X', 'pid': os.getpid(), 'tid': threads[device],
+                          'ts': (started - self.origin) * 1e6, 'dur': seconds * 1e6,
+                          'args': {key: str(value) for key, value in (args or {}).items()}})
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def prometheus(self, metric='questr_stage_seconds'):
+        '''Returns:
+            {str} -- The histograms in the Prometheus text format.
+        '''
+        lines = ['# HELP {} Time spent in each stage.'.format(metric), '# TYPE {} histogram'.format(metric)]
+        for (name, device), histogram in sorted(self.histograms.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            labels = 'stage="{}"'.format(name) + (',device="{}"'.format(device) if device else '')
+            total = 0
+            for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                total += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, bound, total))
+            lines.append('{}_sum{{{}}} {:.6f}'.format(metric, labels, histogram.sum))
+            lines.append('{}_count{{{}}} {}'.format(metric, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        '''Writes the histograms for node_exporter's textfile collector,
+        atomically, so it never reads half a file.
+        '''
+        with open(filename + '.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.replace(filename + '.tmp', filename)
+
+
+# The one every module traces into.
+tracer = Tracer()
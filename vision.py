@@ -0,0 +1,149 @@
+'''Cheap image classifiers that work straight on pixel arrays.
+'''
+import numpy as np
+
+# Hues are in PIL's HSV scale, where the full circle is 0-255 instead of 0-360°.
+HUE_CIRCLE = 255
+
+
+def pixel_hues(im):
+    '''Computes the hue and chroma of every pixel of an image.
+
+    Arguments:
+        im {Image} -- PIL.Image, in any mode convertible to RGB.
+
+    Returns:
+        {tuple} -- (hues, chromas), two flat float arrays. Hues are
+                   angles in radians, chromas are in range 0-255.
+    '''
+    rgb = np.asarray(im.convert('RGB'), dtype=np.float32).reshape(-1, 3)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    mx = rgb.max(axis=1)
+    chroma = mx - rgb.min(axis=1)
+    safe = np.where(chroma == 0, 1, chroma)
+    hue = np.where(mx == r, ((g - b) / safe) % 6,
+          np.where(mx == g, (b - r) / safe + 2,
+                            (r - g) / safe + 4))
+    return hue * (np.pi / 3), chroma
+
+
+def mean_hues(ims):
+    '''Computes the circular mean hue of many images at once.
+
+    Every pixel is weighted by its chroma, so grey and dark pixels,
+    which have no meaningful hue, barely count.
+
+    Arguments:
+        ims {list} -- PIL.Images.
+
+    Returns:
+        {tuple} -- (hues, concentrations), arrays with one value per
+                   image. Hues are in range 0-255; concentrations go
+                   from 0 (no dominant hue) to 1 (a single solid hue).
+    '''
+    if not ims:
+        return np.empty(0), np.empty(0)
+    hues, chromas = zip(*(pixel_hues(im) for im in ims))
+    labels = np.repeat(np.arange(len(ims)), [len(h) for h in hues])
+    hues, chromas = np.concatenate(hues), np.concatenate(chromas)
+
+    x = np.bincount(labels, weights=chromas * np.cos(hues), minlength=len(ims))
+    y = np.bincount(labels, weights=chromas * np.sin(hues), minlength=len(ims))
+    total = np.bincount(labels, weights=chromas, minlength=len(ims))
+
+    mean = (np.arctan2(y, x) % (2 * np.pi)) * HUE_CIRCLE / (2 * np.pi)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        concentration = np.where(total > 0, np.hypot(x, y) / total, 0)
+    return mean, concentration
+
+
+def hue_distance(hue1, hue2):
+    '''Length of the shortest arc between two hues in range 0-255.'''
+    d = np.abs(np.asarray(hue1, dtype=float) - hue2) % HUE_CIRCLE
+    return np.minimum(d, HUE_CIRCLE - d)
+
+
+def classify_hues(ims, hue1, hue2, min_confidence=0.05):
+    '''Tells, for each image, whether its hue is closer to hue1 or hue2.
+
+    The confidence is the fraction of the arc between hue1 and hue2
+    that separates the image hue from the middle point, scaled by how
+    concentrated the image hue is. So it is 0 for grey images or hues
+    right in the middle, and 1 for a solid color exactly on hue1 or
+    hue2.
+
+    Arguments:
+        ims   {list} -- PIL.Images.
+        hue1  {int}  -- 0-255
+        hue2  {int}  -- 0-255
+
+    Keyword Arguments:
+        min_confidence {float} -- Below this, the result is None (default: 0.05).
+
+    Returns:
+        {list} -- One (result, hue, confidence) tuple per image, where
+                  result is True if closer to hue1, False if closer to
+                  hue2 and None if it can't tell.
+    '''
+    hues, concentrations = mean_hues(ims)
+    d1, d2 = hue_distance(hues, hue1), hue_distance(hues, hue2)
+    arc = max(float(hue_distance(hue1, hue2)), 1)
+    confidences = np.clip(np.abs(d2 - d1) / arc, 0, 1) * concentrations
+
+    results = []
+    for hue, a1, a2, confidence in zip(hues, d1, d2, confidences):
+        result = None if confidence < min_confidence else bool(a1 < a2)
+        results.append((result, float(hue), float(confidence)))
+    return results
+
+
+def thumbnail(im, size=(27, 54), mode='L'):
+    '''Shrinks an image into a tiny array, cheap to compare.
+
+    Keyword Arguments:
+        size {tuple} -- Width and height of the thumbnail (default: (27, 54)).
+        mode {str} -- PIL mode: 'L' for grayscale, 'RGB' to also tell
+                      apart colors of the same brightness (default: 'L').
+    '''
+    return np.asarray(im.convert(mode).resize(size), dtype=np.float32)
+
+
+def frame_difference(thumb1, thumb2):
+    '''Mean absolute difference between two thumbnails, from 0 to 255
+    (averaged over the channels too, for RGB ones).
+    '''
+    if thumb1 is None or thumb2 is None or thumb1.shape != thumb2.shape:
+        return 255.0
+    return float(np.abs(thumb1 - thumb2).mean())
+
+
+class ChangeDetector(object):
+    '''Remembers a thumbnail of every region it's shown, to tell
+    which ones changed since the last time they were seen.
+
+    Thumbnails are in color, since what's cached for a region may be
+    its hue (see Main.classify_hue), and a blue pokestop bar turning
+    purple barely changes its brightness.
+
+    Keyword Arguments:
+        threshold {float} -- Mean color level difference above which a
+                             region counts as changed (default: 2.0).
+    '''
+    def __init__(self, threshold=2.0):
+        self.threshold = threshold
+        self.thumbnails = {}
+
+    def update(self, crops):
+        '''Arguments:
+            crops {dict} -- Maps region names to PIL.Images.
+
+        Returns:
+            {set} -- Names of the regions that changed, or are new.
+        '''
+        changed = set()
+        for name, crop in crops.items():
+            current = thumbnail(crop, (16, 16), 'RGB')
+            if frame_difference(self.thumbnails.get(name), current) > self.threshold:
+                changed.add(name)
+                self.thumbnails[name] = current
+        return changed